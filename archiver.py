@@ -1,115 +1,289 @@
 import os
-from pathlib import Path
+import sys
+import copy
+import itertools
+from collections import Counter
+
+from matcher import RomMatcher, DEFAULT_IGNORED_DIRECTORIES
+from metrics import metrics
+
+
+class Game:
+    """
+    Compact record for a single game (rom file or unpacked folder). Sizes are kept in bytes and only formatted when
+    written, filetypes and consoles are interned so every game of a console shares the same strings
+    """
+    __slots__ = ('title', 'filetype', 'path', 'size', 'console', 'rawg_title', 'rawg_release_date', 'rawg_metacritic',
+                 'rawg_genres', 'rawg_tags', 'verified', 'zip_entries', 'zip_entry_count', 'zip_size')
+
+    def __init__(self, title, filetype, path, size, console=None):
+        self.title = title
+        self.filetype = sys.intern(filetype)
+        self.path = path
+        self.size = size
+        self.console = None if console is None else sys.intern(console)
+        self.rawg_title = None
+        self.rawg_release_date = None
+        self.rawg_metacritic = None
+        self.rawg_genres = None
+        self.rawg_tags = None
+        self.verified = None
+        self.zip_entries = None
+        self.zip_entry_count = None
+        self.zip_size = None
+
+    def __repr__(self):
+        return f"Game({self.title!r}, {self.filetype!r}, {self.path!r}, {self.size})"
+
+    def as_dict(self):
+        """
+        :return: dict of the fields that are set, for logging
+        """
+        return {field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None}
+
+    def as_record(self):
+        """
+        :return: list of the scanned fields, for the scan manifest
+        """
+        return [self.title, self.filetype, self.path, self.size]
+
+    @classmethod
+    def from_record(cls, record, console=None):
+        """
+        :param record: list of the scanned fields, as returned by as_record
+        :param console: short name of the console the game belongs to
+        :return: Game
+        """
+        return cls(*record, console=console)
 
 
 class ConsoleArchiver:
     """ Archiver object, to be instantiated for each console """
 
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, logger, console_entry, root_path):
+    def __init__(self, logger, console_entry, library_index, streaming=False,
+                 ignored_directories=DEFAULT_IGNORED_DIRECTORIES):
         self.logger = logger
         self.console_name = console_entry['name']
         self.rom_formats = console_entry['romFormats']
         self.company = console_entry['company']
         self.short_name = console_entry['shortName']
-        self.directory = self.get_console_directory(self.short_name, root_path, self.logger)
-        self.games = self.find_games(self.rom_formats, self.directory, self.logger)
-        self.directory_size = human_readable_size(0) if not self.directory else \
-            human_readable_size(get_folder_size(Path(self.directory)))
+        self.rawg_platform_id = console_entry.get('rawgPlatformId')
+        self.dat_file = console_entry.get('datFile')
+        # Games per verification status, counted as they are verified against the DAT file
+        self.verification_counts = Counter()
+        self.matcher = RomMatcher.from_config(console_entry, ignored_directories)
+        self.directory_node = self.get_console_directory(self.short_name, library_index, self.logger)
+        self.directory = None if not self.directory_node else self.directory_node.path
+        self.streaming = streaming
+        # Archivers of the same console under every rom root, when it was found under several, see combine()
+        self.parts = None
+        if streaming:
+            # Games are generated from the library index while they are written instead of being kept in memory,
+            # they are counted as they are written
+            self.games = None
+            self.game_count = 0
+            self.games_size = 0
+        else:
+            with metrics.phase("find_games", console=self.short_name):
+                self.games = self.load_previous_games(library_index) or \
+                    self.find_games(self.matcher, self.directory_node, self.logger, self.short_name)
+            self.game_count = 0 if not self.games else len(self.games)
+            self.games_size = sum(game.size or 0 for game in self.games or [])
+            metrics.count("games_found", self.game_count, console=self.short_name)
+        self.directory_size = 0 if not self.directory_node else self.directory_node.size
 
-        self.logger.info("New archiver object created.", extra=self.__dict__)
+        self.logger.info("New archiver object created.",
+                         extra={
+                             "console": self.short_name,
+                             "directory": self.directory,
+                             "datFile": self.dat_file,
+                             "gameCount": self.game_count,
+                             "directorySize": self.directory_size
+                         })
 
     def __str__(self):
         return str(f"{self.console_name} ({self.short_name})\n\t"
                    f"Company: {self.company}\n\t"
                    f"Directory: {self.directory}\n\t"
-                   f"Directory Size: {self.directory_size}\t\n"
+                   f"Directory Size: {human_readable_size(self.directory_size)}\t\n"
                    f"Rom Formats: {self.rom_formats}\n\t"
                    f"Games: {self.games}")
 
+    def iter_games(self):
+        """
+        Iterate over the console's games, straight from the library index in streaming mode
+        :return: iterator of games
+        """
+        if not self.streaming:
+            return iter(self.games or [])
+        if self.parts:
+            return itertools.chain.from_iterable(part.iter_games() for part in self.parts)
+        if not self.directory_node:
+            return iter(())
+        return self.scan_games(self.matcher, self.directory_node, self.logger, self.short_name)
+
+    def refresh(self, library_index):
+        """
+        Search the console directory for games again after its indexed listing was refreshed, e.g. in watch mode.
+        The games are new records, so their RAWG fields, verification status and zip contents have to be added again
+        :param library_index: LibraryIndex the console directory was refreshed in
+        """
+        nodes = library_index.find_nodes(self.directory) if self.directory else None
+        self.directory_node = nodes[-1] if nodes else None
+        self.verification_counts = Counter()
+        if not self.streaming:
+            with metrics.phase("find_games", console=self.short_name):
+                self.games = self.find_games(self.matcher, self.directory_node, self.logger, self.short_name)
+            self.game_count = 0 if not self.games else len(self.games)
+            self.games_size = sum(game.size or 0 for game in self.games or [])
+        self.directory_size = 0 if not self.directory_node else self.directory_node.size
+        self.logger.info("Console games refreshed",
+                         extra={
+                             "console": self.short_name,
+                             "gameCount": self.game_count,
+                             "directorySize": self.directory_size
+                         })
+
+    @classmethod
+    def combine(cls, archivers):
+        """
+        Combine the archivers of a console found under several rom roots into one, with the games, sizes and
+        verification counts of all of them, so the console is exported once
+        :param archivers: ConsoleArchiver objects of the same console
+        :return: ConsoleArchiver
+        """
+        combined = copy.copy(archivers[0])
+        combined.parts = archivers
+        combined.directory = "; ".join(archiver.directory for archiver in archivers if archiver.directory)
+        combined.directory_node = None
+        combined.directory_size = sum(archiver.directory_size for archiver in archivers)
+        combined.verification_counts = sum((archiver.verification_counts for archiver in archivers), Counter())
+        if not combined.streaming:
+            combined.games = [game for archiver in archivers for game in archiver.games or []]
+        combined.game_count = sum(archiver.game_count for archiver in archivers)
+        combined.games_size = sum(archiver.games_size for archiver in archivers)
+        return combined
+
+    def load_previous_games(self, library_index):
+        """
+        Reuse the games found by the previous run when nothing under the console directory has changed since
+        :param library_index: LibraryIndex built this run, with the scan manifest it was built from
+        :return: list of games, or None if they need to be searched for again
+        """
+        if not self.directory_node or not library_index.manifest:
+            return None
+        if not all(node.reused for node in self.directory_node.walk()):
+            return None
+
+        records = library_index.manifest.previous_games(self.short_name, self.directory, self.matcher.rules())
+        games = None if not records else [Game.from_record(record, self.short_name) for record in records]
+        if games:
+            self.logger.info(f"Reused {len(games)} games from the scan manifest for {self.short_name}, "
+                             f"console directory unchanged")
+        return games
+
     @staticmethod
-    def get_console_directory(short_name, rom_root_dir, logger):
+    def get_console_directory(short_name, library_index, logger):
         """
-        Recursive search to find and return directory where console games are located
+        Search the library index to find the directory where console games are located
         :param logger: logger
         :param short_name: Short name of the console, the name of the directory to search for
-        :param rom_root_dir: Root directory of all console folders to start recursion from
-        :return: path of the consoles directory
+        :param library_index: LibraryIndex of the rom root directory, all of its subdirs are searched
+        :return: DirectoryNode of the consoles directory
         """
         try:
-            # pylint: disable=unused-variable
-            for root, subdirs, file_list in os.walk(rom_root_dir):
-                for subdir in subdirs:
-                    if subdir.lower() == short_name.lower():
-                        return os.path.join(root, subdir)
+            console_node = library_index.find_directory(short_name)
+            if console_node:
+                return console_node
             logger.warning(f"Could not find a console directory for {short_name} after recursively searching all "
-                           f"subdirs of {rom_root_dir}")
-        except TypeError as e:
+                           f"subdirs of {library_index.root_path}")
+        except (TypeError, AttributeError) as e:
             logger.error(f"Error occurred when trying to locate a console directory for the {short_name} console")
             logger.error(e)
             logger.info(f"Make sure the console directory exists with the name {short_name} (case insensitive)")
         return None
 
     @staticmethod
-    def find_games(rom_formats, console_dir, logger):
+    def find_games(matcher, console_node, logger, console=None):
         """
-        Recursively search a consoles directory for roms that match the configured extensions for this console
+        Recursively search a consoles indexed directory for roms that match the configured extensions for this console
         :param logger: logger
-        :param rom_formats: list of accepted file extensions for this consoles roms
-        :param console_dir: directory to recursively search for roms
-        :return: dict of games, key pairs like game_title: game_path_on_disk
+        :param matcher: RomMatcher with the rom rules of this console
+        :param console_node: DirectoryNode of the console directory to recursively search for roms
+        :param console: short name of the console, recorded on each game
+        :return: list of Game records
         """
-        if not console_dir:
+        if not console_node:
             logger.warning("No console directory configured, skipping game search.")
             return None
 
-        games = []
-        ignored_directories = ['dlc', 'update']
         try:
-            # Look for game folders
-            if "folder" in rom_formats:
-                for subdir in next(os.walk(console_dir))[1]:
-                    game_path = os.path.join(console_dir, subdir)
-                    game = {
-                        "title": subdir,
-                        "filetype": "FOLDER",
-                        "path": game_path,
-                        "size": f"{human_readable_size(get_folder_size(Path(game_path)))}",
-                    }
-                    games.append(game)
-                    logger.info("Rom folder found for console.", extra=game)
-                    ignored_directories.append(subdir.lower())
-
-            # Look for rom files
-            # pylint: disable=unused-variable
-            for root, subdirs, file_list in os.walk(console_dir):
-                for file in file_list:
-                    if file.endswith(tuple(rom_formats)):
-                        game_path = os.path.join(root, file)
-                        game_title = Path(game_path).stem
-
-                        if any(bad_dir in str(Path(game_path).parent).lower() for bad_dir in ignored_directories):
-                            logger.info("File found in ignored directory, skipping", extra={'path': game_path})
-                            continue
-
-                        game = {
-                            "title": game_title,
-                            "filetype": f"{Path(game_path).suffix.replace('.','').upper()}",
-                            "path": game_path,
-                            "size": f"{human_readable_size(Path(game_path).stat().st_size)}",
-                        }
-
-                        logger.info("Rom file found for console.", extra=game)
-                        games.append(game)
-
-            return games
+            return list(ConsoleArchiver.scan_games(matcher, console_node, logger, console))
 
         except TypeError as e:
-            logger.error(f"Error while looking for the games within {console_dir} in the {rom_formats} format\n"
+            logger.error(f"Error while looking for the games within {console_node.path} in the "
+                         f"{sorted(matcher.extensions)} format\n"
                          f"Make sure games exist and in the expected file extensions.")
             logger.error(e)
             return None
 
+    @staticmethod
+    def scan_games(matcher, console_node, logger, console=None):
+        """
+        Generate the games found in a consoles indexed directory, one at a time. Ignored directories and unpacked game
+        folders are pruned from the walk, so the files below them are never looked at
+        :param logger: logger
+        :param matcher: RomMatcher with the rom rules of this console
+        :param console_node: DirectoryNode of the console directory to recursively search for roms
+        :param console: short name of the console, recorded on each game
+        :return: generator of Game records
+        """
+        game_folders = set()
+
+        # Look for game folders
+        if matcher.folders:
+            for subdir in console_node.subdirs:
+                if matcher.is_ignored_directory(subdir.name):
+                    continue
+                game = Game(subdir.name, "FOLDER", subdir.path, subdir.size, console)
+                logger.info("Rom folder found for console.", extra=game.as_dict())
+                game_folders.add(subdir)
+                yield game
+
+        def prune(node):
+            if node in game_folders:
+                return True
+            if matcher.is_ignored_directory(node.name):
+                logger.info("Ignored directory, skipping the files within", extra={'path': node.path})
+                return True
+            return False
+
+        # Look for rom files
+        prefix_length = len(console_node.path) + 1
+        for node in console_node.walk(prune):
+            relative_dir = node.path[prefix_length:].replace(os.sep, '/') if matcher.has_patterns else None
+            for file, file_size in node.files:
+                match = matcher.match_file(file, f"{relative_dir}/{file}" if relative_dir else file)
+                if not match:
+                    continue
+
+                game = Game(match[0], match[1], os.path.join(node.path, file), file_size, console)
+                logger.info("Rom file found for console.", extra=game.as_dict())
+                yield game
+
+
+def combine_archivers(console_archivers):
+    """
+    :param console_archivers: ConsoleArchiver objects, a console can have one for each rom root it was found under
+    :return: list with one ConsoleArchiver per console, in the order the consoles were first found
+    """
+    by_console = {}
+    for archiver in console_archivers:
+        by_console.setdefault(archiver.short_name, []).append(archiver)
+    return [archivers[0] if len(archivers) == 1 else ConsoleArchiver.combine(archivers)
+            for archivers in by_console.values()]
+
 
 def human_readable_size(size, decimal_places=2):
     """
@@ -123,19 +297,3 @@ def human_readable_size(size, decimal_places=2):
             break
         size /= 1024.0
     return f"{size:.{decimal_places}f} {unit}"
-
-
-def get_folder_size(path):
-    """
-    Get a directory's total size
-    :param path: path to the directory
-    :return: int size in bytes for the directory
-    """
-    size = 0
-    # pylint: disable=unused-variable
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            file_path = os.path.join(root, file)
-            size += os.path.getsize(file_path)
-
-    return size
@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+"""
+Microbenchmark of the per-file cost of deciding whether a file is a rom: the old inline checks of find_games against
+the compiled RomMatcher, over a synthetic listing of files spread across directories
+"""
+import os
+import sys
+import timeit
+import argparse
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from matcher import RomMatcher
+
+ROM_FORMATS = ["zip", "bin", "cue", "ccd", "chd", "exe", "iso", "m3u", "pbp", "toc"]
+OTHER_FORMATS = ["txt", "jpg", "sav", "nfo"]
+
+
+def synthetic_listing(file_count, directory_count, folder_games):
+    """
+    :return: list of (directory path, file name) pairs and the folder game names (ignored by the old checks)
+    """
+    extensions = ROM_FORMATS + OTHER_FORMATS
+    listing = []
+    for number in range(file_count):
+        directory = os.path.join("/roms/PSXISO", f"Series {number % directory_count}")
+        if number % 50 == 0:
+            directory = os.path.join(directory, "update")
+        listing.append((directory, f"Game {number} (USA) (Disc 1).{extensions[number % len(extensions)]}"))
+    return listing, [f"Folder Game {number}" for number in range(folder_games)]
+
+
+def legacy_matches(listing, rom_formats, folder_games):
+    """ The checks find_games used to do for every file """
+    ignored_directories = ['dlc', 'update'] + [name.lower() for name in folder_games]
+    matched = 0
+    for root, file in listing:
+        if file.endswith(tuple(rom_formats)):
+            game_path = os.path.join(root, file)
+            Path(game_path).stem  # pylint: disable=expression-not-assigned
+            if any(bad_dir in str(Path(game_path).parent).lower() for bad_dir in ignored_directories):
+                continue
+            Path(game_path).suffix.replace('.', '').upper()  # pylint: disable=expression-not-assigned
+            matched += 1
+    return matched
+
+
+def matcher_matches(listing, matcher):
+    """ The checks find_games does now, ignored directories are pruned once per directory instead of per file """
+    matched = 0
+    ignored = {}
+    for root, file in listing:
+        if root not in ignored:
+            ignored[root] = matcher.is_ignored_directory(os.path.basename(root))
+        if ignored[root]:
+            continue
+        if matcher.match_file(file):
+            matched += 1
+    return matched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--directories", type=int, default=500)
+    parser.add_argument("--folder-games", type=int, default=50, help="folder games appended to the ignored list")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    listing, folder_games = synthetic_listing(args.files, args.directories, args.folder_games)
+    matcher = RomMatcher(ROM_FORMATS)
+    patterned_matcher = RomMatcher(ROM_FORMATS, exclude=["*(Beta)*", r"re:\(Proto( \d)?\)"])
+
+    cases = (
+        ("legacy inline checks", lambda: legacy_matches(listing, ROM_FORMATS, folder_games)),
+        ("RomMatcher", lambda: matcher_matches(listing, matcher)),
+        ("RomMatcher + exclude patterns", lambda: matcher_matches(listing, patterned_matcher)),
+    )
+    for name, case in cases:
+        best = min(timeit.repeat(case, number=1, repeat=args.repeat))
+        print(f"{name:32} {best / args.files * 1e9:10.1f} ns/file  ({case()} roms matched)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#! /usr/bin/env python3
+"""
+Benchmark the scan, RAWG enrichment and export phases of an export run against a synthetic library, with enrichment
+going to a local stub RAWG server. Reports wall and CPU time, stat/scandir calls, read syscalls, peak RSS and rows/sec
+per phase, and saves the results as JSON that can be compared with the results of another commit
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import platform
+import tempfile
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+REPO_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_PATH))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+# pylint: disable=wrong-import-position
+from synthetic_library import generate_library
+from stub_rawg import StubRawgServer
+from scanner import LibraryIndex
+from archiver import ConsoleArchiver
+from rawg import RawgApi
+from exporters import create_exporters, export_games
+from settings import EXPORT_FORMATS
+
+# Relative changes smaller than this are reported as noise when comparing results
+NOISE_THRESHOLD = 0.05
+
+
+class StatCounter:
+    """
+    Counts os.stat, os.lstat and os.scandir calls, and the stat() calls of the entries os.scandir returns, while
+    active. The wrappers slow calls down, so counts are taken on a separate run from the timed one
+    """
+    def __init__(self):
+        self.counts = {'stat': 0, 'scandir': 0}
+        self.originals = {}
+
+    def __enter__(self):
+        counts = self.counts
+        self.originals = {'stat': os.stat, 'lstat': os.lstat, 'scandir': os.scandir}
+        original_stat, original_lstat, original_scandir = os.stat, os.lstat, os.scandir
+
+        class CountedEntry:
+            __slots__ = ('entry', )
+
+            def __init__(self, entry):
+                self.entry = entry
+
+            def __getattr__(self, name):
+                return getattr(self.entry, name)
+
+            def stat(self, **kwargs):
+                counts['stat'] += 1
+                return self.entry.stat(**kwargs)
+
+        class CountedScandir:
+            def __init__(self, path):
+                counts['scandir'] += 1
+                self.iterator = original_scandir(path)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc_info):
+                self.iterator.close()
+
+            def __iter__(self):
+                return (CountedEntry(entry) for entry in self.iterator)
+
+        def counted_stat(*args, **kwargs):
+            counts['stat'] += 1
+            return original_stat(*args, **kwargs)
+
+        def counted_lstat(*args, **kwargs):
+            counts['stat'] += 1
+            return original_lstat(*args, **kwargs)
+
+        os.stat, os.lstat, os.scandir = counted_stat, counted_lstat, CountedScandir
+        return self
+
+    def __exit__(self, *exc_info):
+        os.stat, os.lstat, os.scandir = (self.originals[name] for name in ('stat', 'lstat', 'scandir'))
+
+
+class Phase:
+    """ Measures one phase of the run """
+    def __init__(self, name, results):
+        self.name = name
+        self.results = results
+        self.rows = None
+        self.start_wall = None
+        self.start_cpu = None
+        self.start_reads = None
+
+    def __enter__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+        self.start_reads = read_syscalls()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start_wall
+        result = {
+            'wallSeconds': round(wall, 4),
+            'cpuSeconds': round(cpu_seconds() - self.start_cpu, 4),
+            # Peak RSS of the whole process so far, phases only ever raise it
+            'peakRssMb': round(peak_rss_mb(), 1)
+        }
+        reads = read_syscalls()
+        if reads is not None and self.start_reads is not None:
+            result['readSyscalls'] = reads - self.start_reads
+        if self.rows is not None:
+            result['rows'] = self.rows
+            result['rowsPerSecond'] = round(self.rows / wall, 1) if wall else None
+        self.results['phases'][self.name] = result
+        print(f"{self.name:8} {format_result(result)}")
+
+
+def run(args, logger):
+    """
+    :return: results dict
+    """
+    with open(REPO_PATH / "config.json", encoding='utf-8') as file:
+        config = json.load(file)
+
+    results = {
+        'savedAt': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'parameters': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'phases': {}
+    }
+
+    with tempfile.TemporaryDirectory(prefix="bench_library_") as temp_directory:
+        root = Path(args.library) if args.library else Path(temp_directory) / "library"
+        if not args.library:
+            with Phase("generate", results):
+                generate_library(root, config, args.games, args.rom_size, args.folder_depth, args.extras_ratio,
+                                 args.seed)
+
+        with Phase("scan", results) as phase:
+            library_index = LibraryIndex(logger, root).build(args.scan_workers)
+            archivers = [ConsoleArchiver(logger, console, library_index) for console in config['consoles']]
+            archivers = [archiver for archiver in archivers if archiver.games]
+            phase.rows = sum(len(archiver.games) for archiver in archivers)
+
+        with StatCounter() as counter:
+            LibraryIndex(logger, root).build(args.scan_workers)
+        results['phases']['scan'].update({
+            'statCalls': counter.counts['stat'],
+            'scandirCalls': counter.counts['scandir']
+        })
+        print(f"{'':8} statCalls={counter.counts['stat']} scandirCalls={counter.counts['scandir']}")
+
+        rawg = None
+        if not args.skip_enrich:
+            server = StubRawgServer(latency=args.latency, miss_ratio=args.miss_ratio).start()
+            os.environ.update({
+                'RAWG_ENABLED': 'true',
+                'RAWG_API_KEY': 'benchmark',
+                'RAWG_BASE_URL': server.base_url,
+                'RAWG_CACHE_ENABLED': 'false',
+                'RAWG_WORKERS': str(args.rawg_workers),
+                'RAWG_RATE_LIMIT': str(args.rate_limit)
+            })
+            rawg = RawgApi(logger)
+            with Phase("enrich", results) as phase:
+                rawg.enrich_archivers(archivers)
+                phase.rows = sum(len(archiver.games) for archiver in archivers)
+            results['phases']['enrich']['requests'] = server.requests
+            rawg.close()
+            server.stop()
+
+        config['outputSpreadsheet'] = str(Path(temp_directory) / "games_list.xlsx")
+        with Phase("export", results) as phase:
+            exporters = create_exporters(logger, args.export, config, root, library_index, archivers,
+                                         rawg is not None)
+            for exporter in exporters:
+                exporter.begin()
+            export_games(exporters, archivers)
+            for exporter in exporters:
+                exporter.finish()
+            phase.rows = sum(archiver.game_count for archiver in archivers)
+
+    return results
+
+
+def compare(results, baseline):
+    """ Print the change of every metric from the baseline results """
+    print(f"\nCompared with {baseline.get('commit') or 'baseline'} ({baseline.get('savedAt')}):")
+    if baseline.get('parameters') != results['parameters']:
+        print("  warning: the runs used different parameters")
+    for name, phase in results['phases'].items():
+        for metric, value in phase.items():
+            previous = baseline.get('phases', {}).get(name, {}).get(metric)
+            if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or not previous:
+                continue
+            change = (value - previous) / previous
+            note = "" if abs(change) >= NOISE_THRESHOLD else "  (noise)"
+            print(f"  {name:8} {metric:14} {previous:>12} -> {value:>12}  {change:+.1%}{note}")
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def read_syscalls():
+    """
+    :return: read syscalls made by this process so far, None where /proc isn't available
+    """
+    try:
+        with open("/proc/self/io", encoding='utf-8') as file:
+            for line in file:
+                if line.startswith("syscr:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_PATH, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_result(result):
+    return " ".join(f"{metric}={value}" for metric, value in result.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--library", help="benchmark an existing library instead of generating one")
+    parser.add_argument("--games", type=int, default=1000, help="games generated per console")
+    parser.add_argument("--rom-size", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--folder-depth", type=int, default=4)
+    parser.add_argument("--extras-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scan-workers", type=int, default=8)
+    parser.add_argument("--skip-enrich", action="store_true", help="don't run the RAWG enrichment phase")
+    parser.add_argument("--latency", type=float, default=0.02, help="stub RAWG response latency in seconds")
+    parser.add_argument("--miss-ratio", type=float, default=0.1, help="ratio of searches the stub finds nothing for")
+    parser.add_argument("--rawg-workers", type=int, default=8)
+    parser.add_argument("--rate-limit", type=float, default=1000, help="RAWG requests per second")
+    parser.add_argument("--export", action="append", choices=EXPORT_FORMATS,
+                        help="export formats to benchmark, can be repeated (defaults to xlsx)")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+    args.export = args.export or ['xlsx']
+
+    logger = logging.getLogger("benchmark")
+    logger.addHandler(logging.StreamHandler())
+    # Games RAWG has no results for are logged as errors, which the stub's miss ratio makes plenty of
+    logger.setLevel(logging.CRITICAL)
+    logger.propagate = False
+
+    results = run(args, logger)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f"\nResults saved to {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+#! /usr/bin/env python3
+"""
+Local stand-in for the RAWG api with a configurable latency, answers the connectivity probe, game searches and
+platform listings the way RAWG does so enrichment can be benchmarked without the network or an api key
+"""
+import sys
+import json
+import time
+import zlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubRawgServer:
+    """ Stub RAWG server running on a background thread """
+    def __init__(self, port=0, latency=0.05, miss_ratio=0.1, catalog_size=1000):
+        """
+        :param port: port to listen on, 0 picks a free one
+        :param latency: seconds every response is delayed by
+        :param miss_ratio: ratio of searches that find nothing
+        :param catalog_size: number of games in each platform listing
+        """
+        self.latency = latency
+        self.miss_ratio = miss_ratio
+        self.catalog_size = catalog_size
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/api"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, path, query):
+        """
+        :return: JSON body of the response to a GET request
+        """
+        with self.lock:
+            self.requests += 1
+        time.sleep(self.latency)
+
+        if path.rstrip('/') == '/api':
+            return {}
+        if path.rstrip('/') != '/api/games':
+            return None
+        if 'search' in query:
+            title = query['search'][0]
+            if zlib.crc32(title.encode()) % 1000 < self.miss_ratio * 1000:
+                return {'count': 0, 'results': []}
+            return {'count': 1, 'results': [game_result(title)]}
+
+        page = int(query.get('page', ['1'])[0])
+        page_size = int(query.get('page_size', ['20'])[0])
+        numbers = range((page - 1) * page_size, min(page * page_size, self.catalog_size))
+        results = [game_result(f"Catalog Game {number}") for number in numbers]
+        return {'count': self.catalog_size, 'results': results}
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                url = urlparse(self.path)
+                body = stub.respond(url.path, parse_qs(url.query))
+                data = json.dumps(body if body is not None else {'detail': 'Not found.'}).encode()
+                self.send_response(200 if body is not None else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        return Handler
+
+
+def game_result(title):
+    return {
+        'name': title,
+        'released': '2001-01-01',
+        'metacritic': 80,
+        'genres': [{'name': 'Action'}, {'name': 'Adventure'}],
+        'tags': [{'name': 'Singleplayer'}]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds every response is delayed by")
+    parser.add_argument("--miss-ratio", type=float, default=0.1)
+    args = parser.parse_args()
+
+    server = StubRawgServer(args.port, args.latency, args.miss_ratio).start()
+    print(f"Stub RAWG api listening on {server.base_url}, set RAWG_BASE_URL to it")
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+"""
+Generate a synthetic rom library matching config.json: a directory per console with roms of its configured formats,
+deep PS3-style folder games for consoles accepting folders, and dlc/update directories that have to be ignored.
+Large roms are sparse files, so a library of many TB only takes a few MB of disk
+"""
+import os
+import sys
+import json
+import random
+import zipfile
+import argparse
+from pathlib import Path
+
+CONFIG_PATH = Path(__file__).resolve().parent.parent / "config.json"
+REGIONS = ("USA", "Europe", "Japan", "World")
+# Made up formats some consoles list as placeholders, no files are generated for them
+IGNORED_FORMATS = ("folder", "idk", "TODO")
+
+
+def generate_library(root, config, games_per_console=1000, rom_size=64 * 1024 * 1024, folder_depth=4,
+                     extras_ratio=0.1, seed=0):
+    """
+    :param root: directory the console directories are created in
+    :param config: parsed config file, one directory is created per console
+    :param games_per_console: number of games generated for each console
+    :param rom_size: average apparent size of a rom file, they are sparse so this doesn't use disk space
+    :param folder_depth: depth of the directory tree of folder games
+    :param extras_ratio: ratio of games that also get files in dlc and update directories
+    :param seed: random seed, the same seed generates the same library
+    :return: dict of console short name to the number of games generated
+    """
+    rng = random.Random(seed)
+    root = Path(root)
+    counts = {}
+    for console in config['consoles']:
+        console_path = root / console['shortName']
+        console_path.mkdir(parents=True, exist_ok=True)
+        formats = [rom_format for rom_format in console['romFormats'] if rom_format not in IGNORED_FORMATS]
+        folders = "folder" in console['romFormats']
+
+        for number in range(games_per_console):
+            title = f"{console['shortName']} Game {number} ({rng.choice(REGIONS)})"
+            size = rng.randint(rom_size // 2, rom_size * 3 // 2)
+            if folders and (not formats or number % 2):
+                write_folder_game(console_path / title, folder_depth, size, rng)
+            else:
+                # Series directories give the scan a few levels of nesting
+                directory = console_path / f"Series {number % 25}"
+                directory.mkdir(exist_ok=True)
+                write_rom(directory / f"{title}.{rng.choice(formats)}", size)
+
+            if rng.random() < extras_ratio:
+                extras = console_path / ("dlc" if number % 2 else "update") / title
+                extras.mkdir(parents=True, exist_ok=True)
+                write_rom(extras / f"{title}.{formats[0] if formats else 'pkg'}", size // 10)
+
+        counts[console['shortName']] = games_per_console
+    return counts
+
+
+def write_folder_game(path, depth, size, rng):
+    """ Unpacked PS3/Wii U style game, a few files at every level of a directory tree """
+    directory = path
+    for level in range(depth):
+        directory = directory / ("PS3_GAME" if level == 0 else f"USRDIR{level}")
+        directory.mkdir(parents=True, exist_ok=True)
+        for file_number in range(3):
+            write_sparse(directory / f"DATA{file_number}.BIN", size // (depth * 3))
+    write_sparse(path / "PS3_DISC.SFB", rng.randint(512, 2048))
+
+
+def write_rom(path, size):
+    """ Zips are small but valid, so their central directory can be read, other roms are sparse files """
+    if path.suffix.lower() == ".zip":
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.writestr(f"{path.stem}.bin", path.stem.encode() * 64)
+    else:
+        write_sparse(path, size)
+
+
+def write_sparse(path, size):
+    with open(path, 'wb') as file:
+        file.truncate(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", help="directory to generate the library in")
+    parser.add_argument("--games", type=int, default=1000, help="games per console")
+    parser.add_argument("--rom-size", type=int, default=64 * 1024 * 1024, help="average rom size in bytes")
+    parser.add_argument("--folder-depth", type=int, default=4)
+    parser.add_argument("--extras-ratio", type=float, default=0.1, help="ratio of games with dlc/update files")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(CONFIG_PATH, encoding='utf-8') as file:
+        config = json.load(file)
+    counts = generate_library(args.root, config, args.games, args.rom_size, args.folder_depth, args.extras_ratio,
+                              args.seed)
+    print(f"Generated {sum(counts.values())} games for {len(counts)} consoles in {os.path.abspath(args.root)}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import os
+import json
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from streams import WINDOW_PER_WORKER, ordered_map
+
+# End of central directory record, and the zip64 locator/record used when the counts or offsets overflow it
+EOCD_SIGNATURE = b'PK\x05\x06'
+EOCD_STRUCT = struct.Struct('<4s4H2LH')
+ZIP64_LOCATOR_SIGNATURE = b'PK\x06\x07'
+ZIP64_LOCATOR_STRUCT = struct.Struct('<4sLQL')
+ZIP64_EOCD_SIGNATURE = b'PK\x06\x06'
+ZIP64_EOCD_STRUCT = struct.Struct('<4sQ2H2L4Q')
+CENTRAL_HEADER_SIGNATURE = b'PK\x01\x02'
+CENTRAL_HEADER_STRUCT = struct.Struct('<4s6H3L5H2L')
+ZIP64_EXTRA_ID = 0x0001
+# The end of central directory record is followed by a comment of at most 65535 bytes, the whole range is only read
+# when the record isn't in the last few KB, which usually also hold the central directory of a rom zip
+TAIL_READ_SIZE = 8 * 1024
+MAX_TAIL_SIZE = EOCD_STRUCT.size + 0xFFFF
+
+ZipEntry = namedtuple('ZipEntry', ('name', 'crc', 'size'))
+
+
+class BadZipError(Exception):
+    """ Raised when a file doesn't have a readable zip central directory """
+
+
+class ZipDirectoryReader:
+    """
+    Lists the entries of zip files from their central directory alone. Only the trailing bytes of each file are read,
+    usually in a single read from the end of the file, nothing is decompressed. Listings are kept in the file cache, so
+    unchanged zips are never read again
+    """
+    def __init__(self, logger, file_cache=None):
+        """
+        :param logger: logger
+        :param file_cache: FileCache for the listings, or None to always read the zips
+        """
+        self.logger = logger
+        self.file_cache = file_cache
+
+    def entries(self, path):
+        """
+        :param path: zip file path
+        :return: list of ZipEntry for the files of the zip (directories are left out)
+        :raises BadZipError: if the file isn't a zip
+        :raises OSError: if the file can't be read
+        """
+        stat = os.stat(path)
+        if self.file_cache:
+            listing = self.file_cache.get(path, "zip_directory", stat.st_size, stat.st_mtime_ns)
+            if listing:
+                return [ZipEntry(*entry) for entry in json.loads(listing)]
+
+        entries = read_zip_directory(path, stat.st_size)
+        if self.file_cache:
+            self.file_cache.put(path, "zip_directory", stat.st_size, stat.st_mtime_ns, json.dumps(entries))
+        return entries
+
+
+class ZipInspector:
+    """
+    Adds the contents of zipped games (inner rom names, uncompressed size and entry count) to the games, reading the
+    zip central directories concurrently on a thread pool
+    """
+    def __init__(self, logger, reader, workers=4):
+        """
+        :param logger: logger
+        :param reader: ZipDirectoryReader
+        :param workers: number of threads reading zips concurrently
+        """
+        self.logger = logger
+        self.reader = reader
+        self.workers = max(1, workers)
+
+    def inspect_archivers(self, console_archivers):
+        """
+        Add the zip contents to every zipped game of every console in place
+        :param console_archivers: list of ConsoleArchiver objects
+        """
+        games = [game for archiver in console_archivers for game in archiver.games or [] if game.filetype == "ZIP"]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            inspected = list(executor.map(self.inspect_game, games))
+
+        self.logger.info("Zipped games inspected",
+                         extra={
+                             "zips": len(games),
+                             "multiRom": sum(1 for game in inspected if (game.zip_entry_count or 0) > 1)
+                         })
+
+    def inspect_stream(self, games):
+        """
+        Add the zip contents to games as they are generated, for streaming exports, the zips are read on the worker
+        pool while the games before them are written
+        :param games: iterable of games
+        :return: generator of inspected games
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            yield from ordered_map(executor, self.inspect_game, games, self.workers * WINDOW_PER_WORKER)
+
+    def inspect_game(self, game):
+        """
+        :param game: Game, the zip_ fields of a zipped game are set from the zip central directory
+        :return: the game
+        """
+        if game.filetype != "ZIP":
+            return game
+        try:
+            entries = self.reader.entries(game.path)
+        except (OSError, BadZipError) as e:
+            self.logger.warning("Unable to read the zip central directory, skipping its contents",
+                                extra={
+                                    "path": game.path,
+                                    "error": str(e)
+                                })
+            return game
+
+        game.zip_entries = tuple(entry.name for entry in entries)
+        game.zip_entry_count = len(entries)
+        game.zip_size = sum(entry.size for entry in entries)
+        return game
+
+
+def read_zip_directory(path, file_size):
+    """
+    Read the central directory of a zip from the end of the file, without reading the local headers or file data
+    :param path: zip file path
+    :param file_size: size of the file in bytes
+    :return: list of ZipEntry for the files of the zip (directories are left out)
+    :raises BadZipError: if the file isn't a zip
+    """
+    with open(path, 'rb') as file:
+        for tail_size in (TAIL_READ_SIZE, MAX_TAIL_SIZE):
+            tail_offset = max(0, file_size - tail_size)
+            file.seek(tail_offset)
+            tail = file.read()
+            eocd_position = tail.rfind(EOCD_SIGNATURE)
+            if eocd_position >= 0 or not tail_offset:
+                break
+
+        if eocd_position < 0 or len(tail) - eocd_position < EOCD_STRUCT.size:
+            raise BadZipError("End of central directory record not found")
+        _, _, _, _, entry_count, directory_size, directory_offset, _ = \
+            EOCD_STRUCT.unpack_from(tail, eocd_position)
+
+        locator_position = eocd_position - ZIP64_LOCATOR_STRUCT.size
+        if locator_position >= 0 and tail[locator_position:locator_position + 4] == ZIP64_LOCATOR_SIGNATURE:
+            _, _, zip64_offset, _ = ZIP64_LOCATOR_STRUCT.unpack_from(tail, locator_position)
+            record = read_at(file, tail, tail_offset, zip64_offset, ZIP64_EOCD_STRUCT.size)
+            if record[:4] != ZIP64_EOCD_SIGNATURE:
+                raise BadZipError("Zip64 end of central directory record not found")
+            entry_count, directory_size, directory_offset = ZIP64_EOCD_STRUCT.unpack(record)[-3:]
+
+        directory = read_at(file, tail, tail_offset, directory_offset, directory_size)
+
+    entries = []
+    position = 0
+    for _ in range(entry_count):
+        if len(directory) < position + CENTRAL_HEADER_STRUCT.size or \
+                directory[position:position + 4] != CENTRAL_HEADER_SIGNATURE:
+            raise BadZipError("Truncated central directory")
+        header = CENTRAL_HEADER_STRUCT.unpack_from(directory, position)
+        crc, _, size, name_length, extra_length, comment_length = header[7:13]
+        position += CENTRAL_HEADER_STRUCT.size
+        # Names are cp437 unless the utf-8 flag is set
+        encoding = 'utf-8' if header[3] & 0x800 else 'cp437'
+        name = directory[position:position + name_length].decode(encoding, errors='replace')
+        if size == 0xFFFFFFFF:
+            size = zip64_size(directory[position + name_length:position + name_length + extra_length])
+        position += name_length + extra_length + comment_length
+        if not name.endswith('/'):
+            entries.append(ZipEntry(name, crc, size))
+    return entries
+
+
+def read_at(file, tail, tail_offset, offset, length):
+    """
+    Read part of a file, from the already read tail when it covers it
+    :return: bytes read
+    """
+    if offset >= tail_offset:
+        return tail[offset - tail_offset:offset - tail_offset + length]
+    file.seek(offset)
+    return file.read(length)
+
+
+def zip64_size(extra):
+    """
+    :param extra: extra field of a central directory header
+    :return: uncompressed size from the zip64 extra field
+    """
+    position = 0
+    while position + 4 <= len(extra):
+        field_id, field_length = struct.unpack_from('<2H', extra, position)
+        if field_id == ZIP64_EXTRA_ID:
+            return struct.unpack_from('<Q', extra, position + 4)[0]
+        position += 4 + field_length
+    raise BadZipError("Zip64 extra field not found")
@@ -0,0 +1,162 @@
+import os
+import mmap
+import hashlib
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+PARTIAL_CHUNK_SIZE = 64 * 1024
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class DuplicateFinder:
+    """
+    Finds rom files with identical contents across all consoles. Files are grouped by exact size first, then only
+    the first and last chunks of same sized files are hashed, and files are only hashed in full when those collide.
+    Hashes are read through mmap on a thread pool and kept in the file cache, so unchanged files are never read again
+    """
+    def __init__(self, logger, file_cache=None, workers=4):
+        """
+        :param logger: logger
+        :param file_cache: FileCache for the computed hashes, or None to always read the files
+        :param workers: number of threads reading files concurrently
+        """
+        self.logger = logger
+        self.file_cache = file_cache
+        self.workers = max(1, workers)
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.counter_lock = threading.Lock()
+
+    def find(self, console_archivers):
+        """
+        :param console_archivers: list of ConsoleArchiver objects
+        :return: list of duplicate groups, each a (sha1, size, [Game, ...]) tuple, largest wasted space first
+        """
+        # Sizes are counted in a first pass so only games sharing a size with another one are kept in memory
+        size_counts = Counter(game.size for archiver in console_archivers for game in archiver.iter_games()
+                              if game.filetype != "FOLDER" and game.size)
+        candidates = {}
+        for archiver in console_archivers:
+            for game in archiver.iter_games():
+                if game.filetype != "FOLDER" and size_counts[game.size] > 1:
+                    # The same file can be found twice when console directories are nested
+                    candidates.setdefault(game.path, game)
+        del size_counts
+
+        groups = self.group_by(bucket_by(candidates.values(), lambda game: game.size), self.partial_hash)
+        groups = self.group_by([games for _, games in groups], self.full_hash)
+        duplicates = sorted(((digest, games[0].size, games) for digest, games in groups),
+                            key=lambda group: (-group[1] * (len(group[2]) - 1), group[0]))
+
+        self.logger.info("Duplicate search finished",
+                         extra={
+                             "candidates": len(candidates),
+                             "duplicateGroups": len(duplicates),
+                             "duplicateFiles": sum(len(games) - 1 for _, _, games in duplicates),
+                             "wastedBytes": sum(size * (len(games) - 1) for _, size, games in duplicates),
+                             "filesHashed": self.files_hashed,
+                             "bytesHashed": self.bytes_hashed
+                         })
+        return duplicates
+
+    def group_by(self, groups, hash_function):
+        """
+        Split each group of games further by a hash of their contents, computed concurrently
+        :param groups: iterable of lists of games that are still possible duplicates of each other
+        :param hash_function: function taking a game and returning a digest, or None if the file couldn't be read
+        :return: list of (digest, [Game, ...]) tuples with at least two games each
+        """
+        games = [game for group in groups for game in group]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            digests = list(executor.map(hash_function, games))
+
+        buckets = defaultdict(list)
+        for game, digest in zip(games, digests):
+            if digest:
+                buckets[(game.size, digest)].append(game)
+        return [(digest, bucket) for (_, digest), bucket in buckets.items() if len(bucket) > 1]
+
+    def partial_hash(self, game):
+        """
+        :param game: Game of a rom file
+        :return: sha1 of the first and last chunks of the file, the whole file when it is small enough
+        """
+        return self.cached_hash(game, "partial-sha1", read_partial)
+
+    def full_hash(self, game):
+        """
+        :param game: Game of a rom file
+        :return: sha1 of the whole file
+        """
+        if game.size <= 2 * PARTIAL_CHUNK_SIZE:
+            # The partial hash already covered the whole file
+            return self.partial_hash(game)
+        return self.cached_hash(game, "sha1", read_full)
+
+    def cached_hash(self, game, kind, read_function):
+        try:
+            stat = os.stat(game.path)
+            if self.file_cache:
+                digest = self.file_cache.get(game.path, kind, stat.st_size, stat.st_mtime_ns)
+                if digest:
+                    return digest
+
+            with open(game.path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                sha1 = hashlib.sha1()
+                bytes_read = read_function(mapped, sha1)
+            with self.counter_lock:
+                self.files_hashed += 1
+                self.bytes_hashed += bytes_read
+            digest = sha1.hexdigest()
+
+            if self.file_cache:
+                self.file_cache.put(game.path, kind, stat.st_size, stat.st_mtime_ns, digest)
+            return digest
+
+        except (OSError, ValueError) as e:
+            self.logger.warning("Unable to hash file, skipping it in the duplicate search",
+                                extra={
+                                    "path": game.path,
+                                    "error": str(e)
+                                })
+            return None
+
+
+def bucket_by(games, key):
+    """
+    :param games: iterable of games
+    :param key: function taking a game and returning the value to group by
+    :return: list of groups (lists of games) sharing a key
+    """
+    buckets = defaultdict(list)
+    for game in games:
+        buckets[key(game)].append(game)
+    return list(buckets.values())
+
+
+def read_partial(mapped, sha1):
+    """
+    Hash the first and last chunks of a memory mapped file
+    :return: number of bytes read
+    """
+    if len(mapped) <= 2 * PARTIAL_CHUNK_SIZE:
+        sha1.update(mapped)
+        return len(mapped)
+    sha1.update(mapped[:PARTIAL_CHUNK_SIZE])
+    sha1.update(mapped[-PARTIAL_CHUNK_SIZE:])
+    return 2 * PARTIAL_CHUNK_SIZE
+
+
+def read_full(mapped, sha1):
+    """
+    Hash a whole memory mapped file, a block at a time
+    :return: number of bytes read
+    """
+    view = memoryview(mapped)
+    try:
+        for offset in range(0, len(mapped), HASH_BLOCK_SIZE):
+            sha1.update(view[offset:offset + HASH_BLOCK_SIZE])
+    finally:
+        view.release()
+    return len(mapped)
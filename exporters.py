@@ -0,0 +1,318 @@
+import os
+import csv
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from metrics import metrics
+from settings import is_verifying, is_inspecting_archives
+from spreadsheet import ArchiveWorkbook, get_workbook_path
+
+SQLITE_BATCH_SIZE = 1000
+
+
+class Exporter(ABC):
+    """
+    Export backend, main drives every configured exporter through a single pass over the games: begin(), then game()
+    for each game of a console followed by console() once the console is done, then duplicates() and finish().
+    discard() is called last whether the export finished or not
+    """
+    name = None
+
+    def __init__(self, logger, path, fields):
+        """
+        :param logger: logger
+        :param path: output file path
+        :param fields: Game fields written for each game, see export_fields()
+        """
+        self.logger = logger
+        self.path = Path(path)
+        self.temp_path = Path(f"{path}.tmp")
+        self.fields = fields
+        self.rows = 0
+
+    def begin(self):
+        """ Open the output, the output is written to a temporary file that only replaces the previous one once done """
+
+    @abstractmethod
+    def game(self, archiver, game):
+        """
+        :param archiver: ConsoleArchiver of the game's console
+        :param game: Game record
+        """
+
+    def console(self, archiver):
+        """
+        :param archiver: ConsoleArchiver whose games have all been written, with its final game count
+        """
+
+    def duplicates(self, duplicate_groups):
+        """
+        :param duplicate_groups: list of (sha1, size, [Game, ...]) tuples, see DuplicateFinder.find()
+        """
+
+    def finish(self):
+        """ Close the output and move it in place of the previous one """
+        os.replace(self.temp_path, self.path)
+        self.logger.info(f"Exported {self.rows} games",
+                         extra={
+                             "exporter": type(self).__name__,
+                             "path": str(self.path)
+                         })
+
+    def close(self):
+        """ Close the temporary file, if it is open """
+
+    def discard(self):
+        """
+        Close and remove the temporary file of an export that didn't finish, the previous export is left in place.
+        Does nothing once finish() has moved the temporary file in place
+        """
+        try:
+            self.close()
+            if self.temp_path.exists():
+                self.temp_path.unlink()
+        except (OSError, sqlite3.Error) as e:
+            self.logger.warning("Unable to remove the temporary export file",
+                                extra={
+                                    "exporter": type(self).__name__,
+                                    "path": str(self.temp_path),
+                                    "error": str(e)
+                                })
+
+    def record(self, game):
+        """
+        :param game: Game record
+        :return: dict of the exported fields, lists are kept as lists
+        """
+        return {field: getattr(game, field) for field in self.fields}
+
+    def row(self, game):
+        """
+        :param game: Game record
+        :return: list of the exported field values, lists are joined into a single value
+        """
+        return [
+            ", ".join(value) if isinstance(value, (list, tuple)) else value
+            for value in (getattr(game, field) for field in self.fields)
+        ]
+
+
+class CsvExporter(Exporter):
+    """ Writes a row per game to a CSV file as the games are generated """
+    name = 'csv'
+
+    def __init__(self, logger, path, fields):
+        super().__init__(logger, path, fields)
+        self.file = None
+        self.writer = None
+
+    def begin(self):
+        # pylint: disable=consider-using-with
+        self.file = open(self.temp_path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.fields)
+
+    def game(self, archiver, game):
+        self.writer.writerow(self.row(game))
+        self.rows += 1
+
+    def finish(self):
+        self.close()
+        super().finish()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class JsonLinesExporter(Exporter):
+    """ Writes a JSON object per game and line to a JSON Lines file as the games are generated """
+    name = 'jsonl'
+
+    def __init__(self, logger, path, fields):
+        super().__init__(logger, path, fields)
+        self.file = None
+
+    def begin(self):
+        # pylint: disable=consider-using-with
+        self.file = open(self.temp_path, 'w', encoding='utf-8')
+
+    def game(self, archiver, game):
+        self.file.write(json.dumps(self.record(game)))
+        self.file.write("\n")
+        self.rows += 1
+
+    def finish(self):
+        self.close()
+        super().finish()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class SqliteExporter(Exporter):
+    """
+    Writes the games, consoles and duplicates to tables of an SQLite database, games are inserted in batches as they
+    are generated
+    """
+    name = 'sqlite'
+
+    def __init__(self, logger, path, fields):
+        super().__init__(logger, path, fields)
+        self.connection = None
+        self.batch = []
+
+    def begin(self):
+        if self.temp_path.exists():
+            self.temp_path.unlink()
+        self.connection = sqlite3.connect(str(self.temp_path))
+        self.connection.execute(f"CREATE TABLE games ({', '.join(self.fields)})")
+        self.connection.execute("CREATE TABLE consoles (short_name, name, company, game_count, size, directory)")
+        self.connection.execute("CREATE TABLE duplicates (duplicate_group, sha1, size, console, path)")
+        self.batch = []
+
+    def game(self, archiver, game):
+        self.batch.append(self.row(game))
+        self.rows += 1
+        if len(self.batch) >= SQLITE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.connection.executemany(f"INSERT INTO games VALUES ({', '.join('?' * len(self.fields))})", self.batch)
+        self.batch = []
+
+    def console(self, archiver):
+        self.connection.execute("INSERT INTO consoles VALUES (?, ?, ?, ?, ?, ?)",
+                                (archiver.short_name, archiver.console_name, archiver.company, archiver.game_count,
+                                 archiver.directory_size, archiver.directory))
+
+    def duplicates(self, duplicate_groups):
+        self.connection.executemany("INSERT INTO duplicates VALUES (?, ?, ?, ?, ?)",
+                                    [(group_num, digest, size, game.console, game.path)
+                                     for group_num, (digest, size, games) in enumerate(duplicate_groups, start=1)
+                                     for game in games])
+
+    def finish(self):
+        self.flush()
+        self.connection.commit()
+        self.close()
+        super().finish()
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+
+class XlsxExporter(Exporter):
+    """ Writes the ArchiveWorkbook, with the overview, all, console and duplicates worksheets """
+    name = 'xlsx'
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, logger, config, root_path, library_index, console_archivers, rawg_enabled):
+        super().__init__(logger, get_workbook_path(config, root_path, logger), [])
+        self.workbook = ArchiveWorkbook(logger, config, root_path, library_index, console_archivers, rawg_enabled,
+                                        self.temp_path)
+
+    def begin(self):
+        self.workbook.start_game_tabs()
+
+    def game(self, archiver, game):
+        self.workbook.add_game(archiver, game)
+        self.rows += 1
+
+    def console(self, archiver):
+        self.workbook.end_console_tab(archiver)
+
+    def duplicates(self, duplicate_groups):
+        self.workbook.create_duplicates_tab(duplicate_groups)
+
+    def finish(self):
+        # Update overview tab with console rows, totals, export date, then write changes and close the workbook
+        self.workbook.end_game_tabs()
+        self.workbook.update_overview_tab()
+        self.workbook.write()
+        super().finish()
+
+
+def create_exporters(logger, formats, config, root_path, library_index, console_archivers, rawg_enabled):
+    """
+    :param logger: logger
+    :param formats: list of export formats, see EXPORT_FORMATS
+    :param config: parsed config file
+    :param root_path: rom root directory
+    :param library_index: LibraryIndex built this run
+    :param console_archivers: list of ConsoleArchiver objects
+    :param rawg_enabled: whether the games are enriched from RAWG
+    :return: list of exporters, the flat files are written next to the workbook with their own extension
+    """
+    fields = export_fields(rawg_enabled, is_verifying(config), is_inspecting_archives(config))
+    workbook_path = Path(get_workbook_path(config, root_path, logger))
+    flat_exporters = {'csv': CsvExporter, 'jsonl': JsonLinesExporter, 'sqlite': SqliteExporter}
+
+    exporters = []
+    for export_format in formats:
+        if export_format == 'xlsx':
+            exporters.append(XlsxExporter(logger, config, root_path, library_index, console_archivers, rawg_enabled))
+        else:
+            exporters.append(flat_exporters[export_format](logger, workbook_path.with_suffix(f".{export_format}"),
+                                                           fields))
+    logger.info("Exporters configured", extra={"exporters": list(formats)})
+    return exporters
+
+
+def export_games(exporters, console_archivers, rawg=None, inspector=None, verifier=None):
+    """
+    Drive the exporters through a single pass over the games of every console. Streaming archivers generate their
+    games from the library index here, and they are looked up, inspected and verified as they are generated
+    :param exporters: list of exporters, begun but not finished
+    :param console_archivers: list of ConsoleArchiver objects
+    :param rawg: RawgApi looking up streamed games, when enabled
+    :param inspector: ZipInspector listing streamed zips, when enabled
+    :param verifier: DatVerifier verifying streamed games, when enabled
+    """
+    for archiver in console_archivers:
+        games = archiver.iter_games()
+        if archiver.streaming:
+            if rawg and rawg.enabled:
+                games = rawg.enrich_stream(archiver)
+            if inspector:
+                games = inspector.inspect_stream(games)
+            if verifier:
+                games = verifier.verify_stream(archiver, games)
+
+        # Streaming exports also spend the scan, lookup and verification time of the console's games in here
+        with metrics.phase("export", console=archiver.short_name):
+            game_count, games_size = 0, 0
+            for game in games:
+                for exporter in exporters:
+                    exporter.game(archiver, game)
+                game_count += 1
+                games_size += game.size or 0
+
+            archiver.game_count, archiver.games_size = game_count, games_size
+            for exporter in exporters:
+                exporter.console(archiver)
+                metrics.count("rows_written", game_count, exporter=exporter.name)
+
+
+def export_fields(rawg_enabled, verifying=False, inspecting_archives=False):
+    """
+    :param rawg_enabled: whether the RAWG fields are included
+    :param verifying: whether the DAT verification field is included
+    :param inspecting_archives: whether the zip contents fields are included
+    :return: list of Game fields written by the flat exporters, sizes stay in bytes
+    """
+    fields = ['console', 'title', 'filetype', 'size', 'path']
+    if rawg_enabled:
+        fields += ['rawg_title', 'rawg_release_date', 'rawg_metacritic', 'rawg_genres', 'rawg_tags']
+    if verifying:
+        fields += ['verified']
+    if inspecting_archives:
+        fields += ['zip_entry_count', 'zip_size', 'zip_entries']
+    return fields
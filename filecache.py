@@ -0,0 +1,71 @@
+import sqlite3
+import threading
+
+from metrics import metrics
+
+COMMIT_EVERY = 500
+
+
+class FileCache:
+    """
+    Local SQLite cache of values computed from file contents (hashes, ...), keyed by path and kind of value.
+    A cached value is only returned while the file still has the size and modification time it was computed for,
+    so files that haven't changed are never read again
+    """
+    def __init__(self, logger, path):
+        self.logger = logger
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+
+        # Shared by worker threads, every use of the connection is serialized by the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                "path TEXT NOT NULL, "
+                                "kind TEXT NOT NULL, "
+                                "size INTEGER NOT NULL, "
+                                "mtime_ns INTEGER NOT NULL, "
+                                "value TEXT NOT NULL, "
+                                "PRIMARY KEY (path, kind))")
+        self.connection.commit()
+
+    def get(self, path, kind, size, mtime_ns):
+        """
+        :param path: file path
+        :param kind: kind of value, e.g. "sha1"
+        :param size: current size of the file
+        :param mtime_ns: current modification time of the file in nanoseconds
+        :return: the cached value, or None if not cached or the file has changed since
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM files WHERE path = ? AND kind = ? AND size = ? AND "
+                                          "mtime_ns = ?", (path, kind, size, mtime_ns)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics.count("file_cache_lookups", kind=kind, result="miss")
+                return None
+            self.hits += 1
+        metrics.count("file_cache_lookups", kind=kind, result="hit")
+        return row[0]
+
+    def put(self, path, kind, size, mtime_ns, value):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                                    (path, kind, size, mtime_ns, value))
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.connection.commit()
+                self.pending = 0
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+        self.logger.info("File cache closed",
+                         extra={
+                             "cachePath": str(self.path),
+                             "hits": self.hits,
+                             "misses": self.misses
+                         })
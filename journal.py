@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import threading
+
+# Seconds between fsyncs of the journal, lines are flushed as they are written but only synced to disk this often
+SYNC_INTERVAL = 5
+
+
+class RunJournal:
+    """
+    Append-only JSON Lines journal of the RAWG lookups made by a run, so an interrupted run (reboot, exhausted api
+    quota, Ctrl-C, a deadline) is resumed by the next one instead of starting over. The journal is removed once an
+    export has been written with every game looked up, so a journal found at startup belongs to an unfinished run, or
+    to an enrich command whose lookups are waiting for the export
+    """
+    def __init__(self, logger, path):
+        """
+        :param logger: logger
+        :param path: path of the journal file
+        """
+        self.logger = logger
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.entries = 0
+        self.last_sync = time.monotonic()
+
+    def resume(self, ttl, miss_ttl):
+        """
+        Read the lookups of an interrupted run, a truncated last line (the run was killed while writing it) is skipped,
+        as are lookups older than the RAWG cache would keep them, those games are looked up again
+        :param ttl: seconds a found game is trusted
+        :param miss_ttl: seconds a "no results" answer is trusted
+        :return: dict of (title key, platform) to RAWG result (None for games RAWG had no match for)
+        """
+        lookups = {}
+        expired = 0
+        now = time.time()
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                        if now - entry['fetchedAt'] > (ttl if entry['result'] is not None else miss_ttl):
+                            expired += 1
+                            continue
+                        lookups[(entry['key'], entry.get('platform'))] = entry['result']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            return lookups
+        except OSError as e:
+            self.logger.warning("Unable to read the run journal, not resuming",
+                                extra={
+                                    "journalPath": str(self.path),
+                                    "error": str(e)
+                                })
+            return {}
+
+        if lookups:
+            self.logger.info("Resuming the RAWG lookups of a previous run from its journal",
+                             extra={
+                                 "journalPath": str(self.path),
+                                 "lookups": len(lookups),
+                                 "expiredLookups": expired
+                             })
+        self.entries = len(lookups)
+        return lookups
+
+    def record(self, key, platform, result):
+        """
+        Append a RAWG answer to the journal, safe to call from several threads at once
+        :param key: title key of the game
+        :param platform: short name of the console the game belongs to
+        :param result: trimmed RAWG result, or None when RAWG had no match
+        """
+        line = json.dumps({'key': key, 'platform': platform, 'result': result, 'fetchedAt': time.time()}) + "\n"
+        with self.lock:
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+                self.file.write(line)
+                self.file.flush()
+                self.entries += 1
+                if time.monotonic() - self.last_sync >= SYNC_INTERVAL:
+                    os.fsync(self.file.fileno())
+                    self.last_sync = time.monotonic()
+            except OSError as e:
+                self.logger.warning("Unable to write to the run journal", extra={"error": str(e)})
+
+    def complete(self):
+        """ Remove the journal once an export has been written with every game looked up, nothing is left to resume """
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+            self.entries = 0
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.logger.warning("Unable to remove the run journal", extra={"error": str(e)})
+
+    def close(self):
+        """ Sync the journal to disk, it is kept for the next run unless every game was looked up and exported """
+        with self.lock:
+            if self.file:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+        if self.entries:
+            self.logger.info("Run journal kept, the next run resumes from it",
+                             extra={
+                                 "journalPath": str(self.path),
+                                 "lookups": self.entries
+                             })
@@ -1,9 +1,181 @@
+import queue
+import atexit
 import logging
+import threading
+from collections import Counter
+from logging.handlers import QueueHandler, QueueListener
 from pythonjsonlogger import jsonlogger
 
+DEFAULT_MAX_FIELD_LENGTH = 1000
+DEFAULT_MAX_FIELD_ITEMS = 50
+# Attributes every log record has, anything else was passed as extra
+RECORD_ATTRIBUTES = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one of every N records of the same message for the configured modules and events, so per file events (a line
+    for every rom found) don't flood the log. Warnings and errors are always kept, the number of records left out is
+    summarized per message
+    """
+    def __init__(self, modules=None):
+        """
+        :param modules: dict of module name to its settings, sampleEvery keeps one of every N records of each message
+                        of the module (0 keeps none, only the summary), events sets it for single messages
+        """
+        super().__init__()
+        self.module_rates, self.event_rates = {}, {}
+        self.seen = Counter()
+        self.lock = threading.Lock()
+        self.configure(modules)
+
+    def configure(self, modules):
+        with self.lock:
+            self.module_rates = {module: settings['sampleEvery'] for module, settings in (modules or {}).items()
+                                 if 'sampleEvery' in settings}
+            self.event_rates = {(module, message): sample_every
+                                for module, settings in (modules or {}).items()
+                                for message, sample_every in settings.get('events', {}).items()}
+
+    def sample_every(self, module, message):
+        return self.event_rates.get((module, message), self.module_rates.get(module, 1))
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or (record.module not in self.module_rates
+                                                 and (record.module, record.msg) not in self.event_rates):
+            return True
+        sample_every = self.sample_every(record.module, record.msg)
+        if sample_every == 1:
+            return True
+        key = (record.module, record.msg)
+        with self.lock:
+            self.seen[key] += 1
+            count = self.seen[key]
+        return bool(sample_every) and count % sample_every == 1
+
+    def summary(self):
+        """
+        :return: list of (module, message, records logged, records left out) tuples
+        """
+        with self.lock:
+            summary = []
+            for (module, message), count in self.seen.items():
+                sample_every = self.sample_every(module, message)
+                kept = (count - 1) // sample_every + 1 if sample_every else 0
+                if count > kept:
+                    summary.append((module, message, kept, count - kept))
+            return summary
+
+    def reset(self):
+        with self.lock:
+            self.seen.clear()
+
+
+class FieldGuardFilter(logging.Filter):
+    """
+    Replaces large or non JSON values passed as extra before the record is queued: long strings are truncated, big
+    containers are replaced by their size and other objects by their truncated str. Records are only serialized later
+    on the listener thread, this also keeps them from holding on to (and racing with) the objects that were logged
+    """
+    def __init__(self, max_length=DEFAULT_MAX_FIELD_LENGTH, max_items=DEFAULT_MAX_FIELD_ITEMS):
+        super().__init__()
+        self.max_length = max_length
+        self.max_items = max_items
+
+    def filter(self, record):
+        for name, value in list(record.__dict__.items()):
+            if name not in RECORD_ATTRIBUTES:
+                setattr(record, name, self.guard(value))
+        return True
+
+    def guard(self, value, depth=0):
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        if isinstance(value, str):
+            return value if len(value) <= self.max_length else f"{value[:self.max_length]}... ({len(value)} chars)"
+        if isinstance(value, (list, tuple, set, frozenset, dict)):
+            if len(value) > self.max_items or depth >= 2:
+                return f"<{type(value).__name__} of {len(value)} items>"
+            if isinstance(value, dict):
+                return {str(key): self.guard(item, depth + 1) for key, item in value.items()}
+            return [self.guard(item, depth + 1) for item in value]
+        return self.guard(str(value), depth)
+
+
+class ModuleLevelFilter(logging.Filter):
+    """ Minimum level of the records of some modules, e.g. only warnings from the archiver """
+    def __init__(self, modules=None):
+        super().__init__()
+        self.module_levels = {}
+        self.configure(modules)
+
+    def configure(self, modules):
+        """
+        :param modules: dict of module name to its settings, level is the minimum level of its records
+        """
+        self.module_levels = {module: logging.getLevelName(settings['level'].upper())
+                              for module, settings in (modules or {}).items() if 'level' in settings}
+
+    def filter(self, record):
+        return record.levelno >= self.module_levels.get(record.module, logging.NOTSET)
+
+
+class LogSettings:
+    """
+    Asynchronous logging: the threads that log only filter records and put them on a queue, a listener thread formats
+    them as JSON and writes them
+    """
+    def __init__(self, root_logger):
+        self.logger = root_logger
+        self.levels = ModuleLevelFilter()
+        self.sampling = SamplingFilter()
+        self.guard = FieldGuardFilter()
+        self.handler = QueueHandler(queue.SimpleQueue())
+        for handler_filter in (self.levels, self.sampling, self.guard):
+            self.handler.addFilter(handler_filter)
+
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(jsonlogger.JsonFormatter("%(levelname)s %(message)s %(funcName)s %(module)s"))
+        self.listener = QueueListener(self.handler.queue, stream_handler)
+
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.handler)
+        self.listener.start()
+        atexit.register(self.shutdown)
+
+    def configure(self, settings):
+        """
+        Apply the logging section of the config file
+        :param settings: dict with an optional level, maxFieldLength, maxFieldItems and per module settings under
+                         modules: level, sampleEvery and events
+        """
+        settings = settings or {}
+        self.logger.setLevel(settings.get('level', 'INFO').upper())
+        self.guard.max_length = settings.get('maxFieldLength', DEFAULT_MAX_FIELD_LENGTH)
+        self.guard.max_items = settings.get('maxFieldItems', DEFAULT_MAX_FIELD_ITEMS)
+        self.levels.configure(settings.get('modules'))
+        self.sampling.configure(settings.get('modules'))
+
+    def summarize(self):
+        """ Log how many records sampling left out per message, and start counting again """
+        for module, message, kept, skipped in self.sampling.summary():
+            self.logger.info("Sampled log records",
+                             extra={
+                                 "sampledModule": module,
+                                 "sampledMessage": message,
+                                 "logged": kept,
+                                 "skipped": skipped
+                             })
+        self.sampling.reset()
+
+    def shutdown(self):
+        """ Write every queued record before the program exits """
+        if self.listener is None:
+            return
+        self.summarize()
+        self.listener.stop()
+        self.listener = None
+
+
 logger = logging.getLogger()
-logHandler = logging.StreamHandler()
-formatter = jsonlogger.JsonFormatter("%(levelname)s %(message)s %(funcName)s %(module)s")
-logHandler.setFormatter(formatter)
-logger.setLevel(logging.INFO)
-logger.addHandler(logHandler)
+log_settings = LogSettings(logger)
@@ -1,43 +1,414 @@
 #! /usr/bin/env python3
+import re
 import sys
 import json
+import time
+import argparse
 from pathlib import Path
-from logger import logger
+from datetime import datetime, timedelta
+from logger import logger, log_settings
 
-from archiver import ConsoleArchiver
-from spreadsheet import ArchiveWorkbook
-from rawg import RawgApi
+from metrics import metrics
+from settings import EXPORT_FORMATS
+
+# Every command imports the modules it needs when it runs, so e.g. stats only reads the run report and never loads the
+# scanner, and scan never loads the exporters or the RAWG client and its http stack
+# pylint: disable=import-outside-toplevel
 
 
 def main():
+    args = parse_args()
+
     # Read config file
     config = parse_config()
+    log_settings.configure(config.get('logging'))
+
+    # Without a command the library is scanned, enriched and exported
+    command = {
+        'scan': run_scan,
+        'enrich': run_enrich,
+        'export': run_export,
+        'stats': run_stats
+    }[args.command or 'export']
+    try:
+        return command(config, args)
+    except KeyboardInterrupt:
+        logger.warning("Run interrupted, the next run resumes from the scan manifest and the run journal")
+        return 130
+    finally:
+        log_settings.shutdown()
+
+
+def run_scan(config, args):
+    """
+    Scan the library and save the scan manifests, without exporting
+    :param config: parsed config file
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    scan_library(config, get_rom_root(config), args.full_rescan)
+    log_settings.summarize()
+    metrics.write(logger, get_run_report_path(config), config.get('prometheusTextfile'))
+    return 0
+
+
+def run_enrich(config, args):
+    """
+    Scan the library and look its games up on RAWG, without exporting. The lookups are kept in the RAWG cache and the
+    run journal, the next export reuses them instead of waiting on the api
+    :param config: parsed config file
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    from journal import RunJournal
+    from rawg import RawgApi
+
+    journal = RunJournal(logger, get_run_journal_path(config))
+    rawg = RawgApi(logger, journal, args.deadline)
+    if not rawg.check_enabled():
+        return 1
+    try:
+        # The RAWG api is probed while the library is scanned
+        rawg.connect()
+        _, console_archivers = scan_library(config, get_rom_root(config), args.full_rescan)
+        with metrics.phase("enrich"):
+            rawg.enrich_archivers(console_archivers)
+        log_settings.summarize()
+        metrics.write(logger, get_run_report_path(config), config.get('prometheusTextfile'))
+    finally:
+        rawg.close()
+        journal.close()
+    return 0
+
+
+def run_export(config, args):
+    """
+    Scan the library, add the configured fields to its games and write every configured export, then keep them up to
+    date in watch mode
+    :param config: parsed config file
+    :param args: parsed command line arguments
+    :return: exit code
+    """
+    from filecache import FileCache
+    from verify import DatVerifier
+    from containers import ZipDirectoryReader, ZipInspector
+    from settings import is_verifying, is_inspecting_archives, get_export_formats
+    from journal import RunJournal
+    from rawg import RawgApi
+
+    # Unknown export formats of the config file are rejected before any work is done
+    export_formats = get_export_formats(config, logger, args.export)
 
     # Get root path
     root_rom_path = get_rom_root(config)
 
-    # Instantiate an object for each console with the necessary attributes
+    # Create RAWG API object, enabled via env var. Its lookups are journaled, so an interrupted run is resumed by the
+    # next one, and none are started once the deadline is reached. The api is probed while the library is scanned
+    journal = RunJournal(logger, get_run_journal_path(config))
+    rawg = RawgApi(logger, journal, args.deadline)
+    rawg.connect()
+
+    library_index, console_archivers = scan_library(config, root_rom_path, args.full_rescan)
+
+    # File hashes are kept in the file cache between runs, so only new or changed files are ever read
+    file_cache = None
+    if config.get('findDuplicates') or is_verifying(config) or is_inspecting_archives(config):
+        file_cache = FileCache(logger, get_file_cache_path(config))
+    zip_reader = ZipDirectoryReader(logger, file_cache)
+    inspector = None
+    if is_inspecting_archives(config):
+        inspector = ZipInspector(logger, zip_reader, get_archive_workers(config))
+    verifier = None
+    if is_verifying(config):
+        verifier = DatVerifier(logger, zip_reader, file_cache, get_verify_workers(config))
+
+    def export(library_index, console_archivers, changed_archivers):
+        add_game_fields(config, changed_archivers, rawg, inspector, verifier)
+        # Streaming exports look their games up while writing them, the api is probed before any export file is opened
+        rawg.wait_connected()
+        write_exports(config, export_formats, root_rom_path, library_index, console_archivers, rawg, inspector,
+                      verifier, file_cache)
+        # Games that couldn't be looked up before the deadline or while RAWG was down are left for the next run
+        if rawg.enrichment_complete:
+            journal.complete()
+
+    try:
+        export(library_index, console_archivers, console_archivers)
+
+        # Keep the exports up to date as games are added, removed or replaced, until interrupted
+        if args.watch:
+            from watcher import LibraryWatcher
+
+            def regenerate(library_index, console_archivers, changed_archivers):
+                with metrics.phase("save_manifest"):
+                    library_index.save_manifests(logger, console_archivers)
+                export(library_index, console_archivers, changed_archivers)
+
+            LibraryWatcher(logger, library_index, console_archivers, get_watch_debounce(config),
+                           get_watch_rescan_interval(config),
+                           get_scan_workers(config)).run(regenerate, lambda: scan_library(config, root_rom_path))
+    finally:
+        # Commit the file hashes and the journaled lookups made so far, they are reused by the next run
+        rawg.close()
+        journal.close()
+        if file_cache:
+            file_cache.close()
+    return 0
+
+
+def run_stats(config, args):
+    """
+    Print the games and sizes of each console as JSON, from the totals kept in the run report of the last run. Only
+    that file is read and the rom roots aren't touched, so monitoring can call it as often as it likes
+    :param config: parsed config file
+    :param args: parsed command line arguments
+    :return: exit code, 1 when there is no run report with the scanned rom roots
+    """
+    # pylint: disable=unused-argument
+    last_run, report = None, {}
+    try:
+        with open(get_run_report_path(config), encoding='utf-8') as file:
+            report = json.load(file)
+        last_run = {'startedAt': report.get('startedAt'), 'runSeconds': report.get('runSeconds')}
+    except (OSError, ValueError):
+        pass
+
+    # Games are only counted while they are exported in streaming mode, their totals are unknown (None) after a scan
+    consoles = report.get('consoles') or []
+    games = [console['games'] for console in consoles]
+    print(
+        json.dumps(
+            {
+                'scans': report.get('scans') or [],
+                'lastRun': last_run,
+                'consoles': consoles,
+                'totalGames': None if None in games else sum(games),
+                'totalSize': sum(console['directorySize'] for console in consoles)
+            },
+            indent=2))
+    return 0 if report.get('scans') else 1
+
+
+def scan_library(config, root_rom_path, full_rescan=False):
+    """
+    Index every rom root and search them for the games of their consoles, then save the scan manifests
+    :param config: parsed config file
+    :param root_rom_path: rom root directory, used when no romRoots are configured
+    :param full_rescan: whether to ignore the scan manifests and list every directory again
+    :return: (MultiRootIndex, list of the ConsoleArchiver objects of the consoles found) tuple, a console found under
+             several rom roots has an archiver for each of them
+    """
+    from archiver import ConsoleArchiver
+    from roots import MultiRootIndex, build_index, scan_roots
+    from settings import is_streaming_export
+
+    # Walk every rom root once, every console lookup, game search and size comes from these indexes. Unchanged
+    # directories are reused from the scan manifests, several roots are scanned in parallel processes
+    roots = get_rom_roots(config, root_rom_path)
+    with metrics.phase("scan"):
+        if config.get('romRoots'):
+            scans = scan_roots(logger, roots, get_scan_workers(config), full_rescan, config.get('logging'))
+        else:
+            scans = [(roots[0], build_index(logger, roots[0].path, roots[0].manifest_path, get_scan_workers(config),
+                                            full_rescan))]
+    library_index = MultiRootIndex(scans)
+
+    # Instantiate an object for each console with the necessary attributes, under each root it is looked for in
+    streaming = is_streaming_export(config)
     console_archivers = []
-    for console in config['consoles']:
-        archiver = ConsoleArchiver(logger, console, root_rom_path)
-        if archiver.games:
-            console_archivers.append(archiver)
+    with metrics.phase("find_games"):
+        for console in config['consoles']:
+            searched = [(root, index) for root, index in scans
+                        if root.consoles is None or console['shortName'].lower() in root.consoles]
+            if config.get('romRoots'):
+                # A console is usually under only some of the roots, it is reported missing once, not for each root
+                searched = [(root, index) for root, index in searched if index.find_directory(console['shortName'])]
+                if not searched:
+                    logger.warning(f"Could not find a console directory for {console['shortName']} under any rom root")
+                    continue
+            for root, index in searched:
+                archiver = ConsoleArchiver(logger, console, index, streaming, get_ignored_directories(config))
+                if archiver.games or streaming and archiver.directory_node:
+                    console_archivers.append(archiver)
+
+    with metrics.phase("save_manifest"):
+        library_index.save_manifests(logger, console_archivers)
+    metrics.attach('scans', [{'rootPath': str(root.path), 'savedAt': datetime.now().isoformat()} for root, _ in scans])
+    record_console_totals(console_archivers, counted=not streaming)
+    return library_index, console_archivers
+
 
-    # Create RAWG API object, enabled via env var
-    rawg = RawgApi(logger)
+def record_console_totals(console_archivers, counted=True):
+    """
+    Keep the totals of each console in the run report, the stats command reads them instead of the scan manifests
+    :param console_archivers: ConsoleArchiver objects, those of a console found under several rom roots are combined
+    :param counted: whether the games were counted, streaming exports only count them while writing them
+    """
+    from archiver import combine_archivers
 
-    # Setup workbook
-    archive_spreadsheet = ArchiveWorkbook(logger, config, root_rom_path, console_archivers, rawg)
+    metrics.attach('consoles', [{
+        'shortName': archiver.short_name,
+        'directory': archiver.directory,
+        'games': archiver.game_count if counted else None,
+        'gamesSize': archiver.games_size if counted else None,
+        'directorySize': archiver.directory_size
+    } for archiver in combine_archivers(console_archivers)])
 
-    # Create tabs for each console and an All tab
-    archive_spreadsheet.create_all_tab()
-    archive_spreadsheet.create_console_tabs()
 
-    # Update overview tab with console rows, totals, export date
-    archive_spreadsheet.update_overview_tab()
+def add_game_fields(config, console_archivers, rawg, inspector, verifier):
+    """
+    Add the zip contents, verification status and RAWG fields to the games of the consoles. Streaming exports add them
+    while the games are written instead, so they never all have to be in memory
+    :param config: parsed config file
+    :param console_archivers: ConsoleArchiver objects whose games need their fields added
+    :param rawg: RawgApi
+    :param inspector: ZipInspector, or None when zip contents aren't listed
+    :param verifier: DatVerifier, or None when no console has a DAT file
+    """
+    from settings import is_streaming_export
+
+    if is_streaming_export(config):
+        return
+
+    # List the contents of zipped games
+    if inspector:
+        with metrics.phase("inspect_archives"):
+            inspector.inspect_archivers(console_archivers)
+
+    # Check the games of consoles with a DAT file
+    if verifier:
+        with metrics.phase("verify"):
+            verifier.verify_archivers(console_archivers)
+
+    # Look up all games on RAWG up front, concurrently, so writing the workbook never waits on the api
+    if rawg.enabled:
+        with metrics.phase("enrich"):
+            rawg.enrich_archivers(console_archivers)
+
+
+def write_exports(config, export_formats, root_rom_path, library_index, console_archivers, rawg, inspector, verifier,
+                  file_cache):
+    """
+    Write every configured export in a single pass over the games, then the run report
+    :param config: parsed config file
+    :param export_formats: export formats to write, see settings.get_export_formats()
+    :param root_rom_path: rom root directory
+    :param library_index: MultiRootIndex of the rom roots
+    :param console_archivers: every ConsoleArchiver to export
+    :param rawg: RawgApi
+    :param inspector: ZipInspector, or None when zip contents aren't listed
+    :param verifier: DatVerifier, or None when no console has a DAT file
+    :param file_cache: FileCache, or None when no file is hashed
+    """
+    # pylint: disable=too-many-arguments
+    from archiver import combine_archivers
+    from duplicates import DuplicateFinder
+    from exporters import create_exporters, export_games
 
-    # Write changes, close workbook
-    archive_spreadsheet.write()
+    # A console found under several rom roots is exported once, with the games of all of them
+    console_archivers = combine_archivers(console_archivers)
+
+    # Setup the exporters, they are all written in a single pass over the games
+    exporters = create_exporters(logger, export_formats, config, root_rom_path, library_index, console_archivers,
+                                 rawg.enabled)
+
+    # Every export is written to a temporary file that replaces the previous export once finished, whatever stops the
+    # export the temporary files left are removed and the previous exports are left in place
+    try:
+        for exporter in exporters:
+            exporter.begin()
+
+        # Export the games of every console, e.g. an All tab and tabs for each console of the workbook
+        with metrics.phase("export"):
+            export_games(exporters, console_archivers, rawg, inspector, verifier)
+
+        # Add the roms that have identical contents, e.g. a Duplicates tab of the workbook
+        if config.get('findDuplicates'):
+            with metrics.phase("duplicates"):
+                duplicate_groups = DuplicateFinder(logger, file_cache,
+                                                   get_duplicate_workers(config)).find(console_archivers)
+                for exporter in exporters:
+                    exporter.duplicates(duplicate_groups)
+
+        # Write totals and close every export
+        with metrics.phase("finish_exports"):
+            for exporter in exporters:
+                exporter.finish()
+    finally:
+        for exporter in exporters:
+            exporter.discard()
+
+    # Report the time spent in each phase and the counters of the run, as the last log line, with the totals of each
+    # console as exported
+    record_console_totals(console_archivers)
+    log_settings.summarize()
+    metrics.write(logger, get_run_report_path(config), config.get('prometheusTextfile'))
+
+
+def parse_args():
+    # The options are accepted before and after the command, the copies of the commands have no defaults so they only
+    # override the options given before the command
+    parser = argparse.ArgumentParser(description="Export a multi-console game library to a spreadsheet",
+                                     parents=option_parsers(),
+                                     epilog="without a command the library is scanned, enriched and exported")
+    full_rescan, export, deadline = option_parsers(argparse.SUPPRESS)
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.add_parser("scan", parents=[full_rescan], help="scan the library and save the scan manifest")
+    commands.add_parser("enrich", parents=[full_rescan, deadline],
+                        help="scan the library and look its games up on RAWG, for the next export to reuse")
+    commands.add_parser("export", parents=[full_rescan, export, deadline],
+                        help="scan the library, add the fields of its games and write the exports (the default)")
+    commands.add_parser("stats", help="print the games and sizes of each console from the last scan, as JSON, without "
+                        "scanning")
+    return parser.parse_args()
+
+
+def option_parsers(default=None):
+    """
+    Build the parent parsers of the options shared by the commands
+    :param default: default of every option, argparse.SUPPRESS to leave options that aren't given unset
+    :return: (full rescan, export, deadline) tuple of parsers
+    """
+    full_rescan = argparse.ArgumentParser(add_help=False, argument_default=default)
+    full_rescan.add_argument("--full-rescan", action="store_true",
+                             help="ignore the scan manifest and list every directory again")
+    deadline = argparse.ArgumentParser(add_help=False, argument_default=default)
+    deadline.add_argument("--deadline", type=parse_deadline, metavar="TIME",
+                          help="stop starting RAWG lookups at this time of day (HH:MM) or after this long (e.g. 90m, "
+                          "2h), the remaining games are exported without RAWG fields and looked up by the next run")
+    export = argparse.ArgumentParser(add_help=False, argument_default=default)
+    export.add_argument("--export", action="append", choices=EXPORT_FORMATS, metavar="FORMAT",
+                        help="export format to write, can be repeated, overrides the exporters of the config file "
+                        "(xlsx, csv, jsonl or sqlite)")
+    export.add_argument("--watch", action="store_true",
+                        help="keep running after the export, writing it again whenever games are added, removed or "
+                        "changed")
+    return full_rescan, export, deadline
+
+
+def parse_deadline(value):
+    """
+    Parse the --deadline option, a time of day or a duration from now
+    :param value: "HH:MM" (the next time the clock shows it), or a number of seconds, minutes or hours ("45s", "90m",
+                  "2h", minutes without a unit)
+    :return: deadline as a time.time() timestamp
+    """
+    value = value.strip().lower()
+    clock = re.fullmatch(r"(\d{1,2}):(\d{2})", value)
+    duration = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([smh]?)", value)
+    try:
+        if clock:
+            now = datetime.now()
+            deadline = now.replace(hour=int(clock.group(1)), minute=int(clock.group(2)), second=0, microsecond=0)
+            if deadline <= now:
+                deadline += timedelta(days=1)
+            return deadline.timestamp()
+        if duration:
+            return time.time() + float(duration.group(1)) * {'s': 1, 'm': 60, 'h': 3600}[duration.group(2) or 'm']
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError(f"invalid deadline {value!r}, expected a time of day (HH:MM) or a duration "
+                                     "(e.g. 90m)")
 
 
 def parse_config():
@@ -62,5 +433,165 @@ def get_rom_root(config, default=Path(__file__).parent.parent):
     return default
 
 
+def get_rom_roots(config, root_rom_path):
+    """
+    Get the rom roots to scan, each with the consoles looked for under it and its own scan manifest. Without romRoots
+    in the config file the rom root directory is the only one
+    :param config: parsed config file
+    :param root_rom_path: rom root directory
+    :return: list of RomRoot
+    """
+    from roots import DEFAULT_ROOT_TIMEOUT, RomRoot
+
+    if not config.get('romRoots'):
+        return [RomRoot(root_rom_path, None, None, get_manifest_path(config))]
+
+    roots = []
+    for number, entry in enumerate(config['romRoots']):
+        consoles = [short_name.lower() for short_name in entry['consoles']] if entry.get('consoles') else None
+        roots.append(RomRoot(entry['path'], consoles, entry.get('timeoutSeconds') or DEFAULT_ROOT_TIMEOUT,
+                             get_manifest_path(config, number)))
+    logger.info("Rom roots configured from file", extra={"romRoots": [root.path for root in roots]})
+    return roots
+
+
+def get_scan_workers(config, default=1):
+    """
+    Get the number of threads used to scan the rom root, directories on network storage benefit from several
+    :param config: parsed config file
+    :param default: default number of workers to use if not configured in file
+    :return: number of scan workers
+    """
+    if 'scanWorkers' in config and config['scanWorkers']:
+        logger.info("Scan workers configured from file", extra={"scanWorkers": config['scanWorkers']})
+        return int(config['scanWorkers'])
+    return default
+
+
+def get_ignored_directories(config):
+    """
+    Get the directory names whose files are never considered roms, for all consoles
+    :param config: parsed config file
+    :return: list of directory names (matched case insensitively, anywhere in the name)
+    """
+    from matcher import DEFAULT_IGNORED_DIRECTORIES
+
+    if 'ignoredDirectories' in config:
+        return config['ignoredDirectories']
+    return list(DEFAULT_IGNORED_DIRECTORIES)
+
+
+def get_manifest_path(config, root_number=None, default=Path(__file__).parent / "scan_manifest.json"):
+    """
+    Get the path of the scan manifest used for incremental rescans, if not configured keep it next to this program
+    :param config: parsed config file
+    :param root_number: position of the rom root in romRoots, each root has its own manifest next to the configured one
+    :param default: default path to use if not configured in file
+    :return: scan manifest path
+    """
+    path = Path(config['scanManifest']) if 'scanManifest' in config and config['scanManifest'] else default
+    if root_number is None:
+        return path
+    return path.with_name(f"{path.stem}.{root_number}{path.suffix}")
+
+
+def get_file_cache_path(config, default=Path(__file__).parent / "file_cache.sqlite3"):
+    """
+    Get the path of the cache of file hashes, if not configured keep it next to this program
+    :param config: parsed config file
+    :param default: default path to use if not configured in file
+    :return: file cache path
+    """
+    if 'fileCache' in config and config['fileCache']:
+        return config['fileCache']
+    return default
+
+
+def get_duplicate_workers(config, default=4):
+    """
+    Get the number of threads hashing files while looking for duplicates
+    :param config: parsed config file
+    :param default: default number of workers to use if not configured in file
+    :return: number of hashing workers
+    """
+    if 'duplicateWorkers' in config and config['duplicateWorkers']:
+        return int(config['duplicateWorkers'])
+    return default
+
+
+def get_verify_workers(config, default=4):
+    """
+    Get the number of threads hashing files while verifying games against DAT files
+    :param config: parsed config file
+    :param default: default number of workers to use if not configured in file
+    :return: number of verification workers
+    """
+    if 'verifyWorkers' in config and config['verifyWorkers']:
+        return int(config['verifyWorkers'])
+    return default
+
+
+def get_archive_workers(config, default=8):
+    """
+    Get the number of threads reading zip central directories, each read is small so more threads hide storage latency
+    :param config: parsed config file
+    :param default: default number of workers to use if not configured in file
+    :return: number of archive workers
+    """
+    if 'archiveWorkers' in config and config['archiveWorkers']:
+        return int(config['archiveWorkers'])
+    return default
+
+
+def get_run_report_path(config, default=Path(__file__).parent / "run_report.json"):
+    """
+    Get the path of the JSON run report with the phase timings and counters, if not configured keep it next to this
+    program
+    :param config: parsed config file
+    :param default: default path to use if not configured in file
+    :return: run report path
+    """
+    if 'runReport' in config and config['runReport']:
+        return config['runReport']
+    return default
+
+
+def get_run_journal_path(config, default=Path(__file__).parent / "run_journal.jsonl"):
+    """
+    Get the path of the journal of the RAWG lookups of a run, resumed by the next run if this one doesn't finish. If
+    not configured keep it next to this program
+    :param config: parsed config file
+    :param default: default path to use if not configured in file
+    :return: run journal path
+    """
+    if 'runJournal' in config and config['runJournal']:
+        return config['runJournal']
+    return default
+
+
+def get_watch_debounce(config, default=10):
+    """
+    Get how long watch mode waits for changes to settle before writing the exports again
+    :param config: parsed config file
+    :param default: default number of seconds to use if not configured in file
+    :return: debounce time in seconds
+    """
+    if 'watchDebounceSeconds' in config and config['watchDebounceSeconds']:
+        return float(config['watchDebounceSeconds'])
+    return default
+
+
+def get_watch_rescan_interval(config, default=15):
+    """
+    Get how often watch mode rescans the library when inotify can't be used
+    :param config: parsed config file
+    :param default: default number of minutes to use if not configured in file
+    :return: rescan interval in seconds
+    """
+    if 'watchRescanMinutes' in config and config['watchRescanMinutes']:
+        return float(config['watchRescanMinutes']) * 60
+    return default * 60
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,125 @@
+import json
+import os
+from datetime import datetime
+
+MANIFEST_VERSION = 2
+
+
+class ScanManifest:
+    """ Persisted snapshot of the last scan, lets nightly runs skip directories that have not changed """
+    def __init__(self, logger, path):
+        self.logger = logger
+        self.path = path
+        self.root_path = None
+        self.saved_at = None
+        self.directories = {}
+        self.games = {}
+
+    def load(self, root_path):
+        """
+        Read the manifest written by the previous run, a missing or unreadable manifest just means a full rescan
+        :param root_path: rom root directory of this run, a manifest for a different root is ignored
+        :return: True if a usable manifest was loaded
+        """
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            self.logger.info("No scan manifest found, doing a full scan", extra={"manifestPath": str(self.path)})
+            return False
+        except (OSError, ValueError) as e:
+            self.logger.warning("Unable to read scan manifest, doing a full scan",
+                                extra={
+                                    "manifestPath": str(self.path),
+                                    "error": str(e)
+                                })
+            return False
+
+        if data.get('version') != MANIFEST_VERSION or data.get('rootPath') != str(root_path):
+            self.logger.info("Scan manifest is from another version or rom root, doing a full scan",
+                             extra={"manifestPath": str(self.path)})
+            return False
+
+        self.root_path = data['rootPath']
+        self.saved_at = data.get('savedAt')
+        for path, mtime, files, subdirs in data['directories']:
+            self.directories[path] = (mtime, [tuple(file) for file in files], subdirs)
+        self.games = data['games']
+        self.logger.info("Scan manifest loaded",
+                         extra={
+                             "manifestPath": str(self.path),
+                             "savedAt": data.get('savedAt'),
+                             "directories": len(self.directories)
+                         })
+        return True
+
+    def previous_listing(self, path, mtime):
+        """
+        Get the listing recorded for a directory if it has not been modified since
+        :param path: path of the directory
+        :param mtime: current modification time of the directory
+        :return: (files, subdir_names) tuple, or None if the directory is new or has changed
+        """
+        entry = self.directories.get(path)
+        if entry and entry[0] == mtime:
+            return entry[1], entry[2]
+        return None
+
+    def previous_games(self, short_name, directory, rules):
+        """
+        Get the games discovered for a console by the previous run
+        :param short_name: short name of the console
+        :param directory: current console directory path
+        :param rules: current rom matching rules of the console, see RomMatcher.rules()
+        :return: list of game records, or None if not recorded or recorded with a different directory/rules
+        """
+        entry = self.games.get(short_name)
+        if entry and entry['directory'] == directory and entry.get('rules') == rules:
+            return entry['games']
+        return None
+
+    def save(self, library_index, console_archivers):
+        """
+        Write the manifest for the next run, written to a temporary file first so a crash can't leave it truncated
+        :param library_index: LibraryIndex built this run
+        :param console_archivers: list of ConsoleArchiver objects with the games found this run, only the ones under
+                                  the rom root of the index are saved
+        """
+        data = {
+            'version': MANIFEST_VERSION,
+            'rootPath': str(library_index.root_path),
+            'savedAt': datetime.now().isoformat(),
+            'directories': [(node.path, node.mtime, node.files, [subdir.name for subdir in node.subdirs])
+                            for node in library_index.root.walk()],
+            'games': {
+                archiver.short_name: {
+                    'directory': archiver.directory,
+                    'rules': archiver.matcher.rules(),
+                    'games': [game.as_record() for game in archiver.games]
+                }
+                for archiver in console_archivers
+                if archiver.games and is_within(archiver.directory, str(library_index.root_path))
+            }
+        }
+
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(data, file)
+            os.replace(temp_path, self.path)
+            self.logger.info("Scan manifest saved",
+                             extra={
+                                 "manifestPath": str(self.path),
+                                 "directories": len(data['directories'])
+                             })
+        except OSError as e:
+            self.logger.error("Unable to save scan manifest", extra={"manifestPath": str(self.path), "error": str(e)})
+
+
+def is_within(path, directory):
+    """
+    :return: whether a path is the directory or is below it
+    """
+    if path is None or directory is None:
+        return False
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
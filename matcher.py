@@ -0,0 +1,100 @@
+import re
+import fnmatch
+
+DEFAULT_IGNORED_DIRECTORIES = ('dlc', 'update')
+REGEX_PREFIX = "re:"
+
+
+class RomMatcher:
+    """
+    Rules deciding which files of a console directory are roms, compiled once per console: a case insensitive
+    extension set lookup, ignored directory names that are pruned from the walk, and optional include/exclude patterns
+    """
+    def __init__(self, rom_formats, ignored_directories=DEFAULT_IGNORED_DIRECTORIES, include=None, exclude=None):
+        """
+        :param rom_formats: list of accepted file extensions, "folder" also accepts unpacked game folders
+        :param ignored_directories: directories with any of these in their name (case insensitive) are skipped
+        :param include: glob or "re:" regex patterns, when set only files with a matching path are roms
+        :param exclude: glob or "re:" regex patterns, files with a matching path are never roms
+        """
+        self.folders = "folder" in rom_formats
+        self.extensions = frozenset(rom_format.lower().lstrip('.') for rom_format in rom_formats
+                                    if rom_format != "folder")
+        self.ignored_directories = tuple(name.lower() for name in ignored_directories)
+        self.include_patterns = list(include or [])
+        self.exclude_patterns = list(exclude or [])
+        self.include = compile_patterns(self.include_patterns)
+        self.exclude = compile_patterns(self.exclude_patterns)
+
+    @classmethod
+    def from_config(cls, console_entry, ignored_directories=DEFAULT_IGNORED_DIRECTORIES):
+        """
+        :param console_entry: console entry of the config file
+        :param ignored_directories: ignored directory names configured for all consoles
+        :return: RomMatcher for the console
+        """
+        return cls(console_entry['romFormats'],
+                   list(ignored_directories) + console_entry.get('ignoredDirectories', []),
+                   console_entry.get('include'),
+                   console_entry.get('exclude'))
+
+    @property
+    def has_patterns(self):
+        return self.include is not None or self.exclude is not None
+
+    def rules(self):
+        """
+        :return: JSON serializable description of the rules, games found with different rules can't be reused
+        """
+        return {
+            'extensions': sorted(self.extensions),
+            'folders': self.folders,
+            'ignoredDirectories': list(self.ignored_directories),
+            'include': self.include_patterns,
+            'exclude': self.exclude_patterns
+        }
+
+    def match_file(self, name, relative_path=None):
+        """
+        Check whether a file is a rom
+        :param name: file name
+        :param relative_path: path of the file relative to the console directory, include/exclude patterns are matched
+                              against it, defaults to the file name
+        :return: (title, filetype) tuple for roms, otherwise None
+        """
+        title, dot, extension = name.rpartition('.')
+        if not dot or not title or extension.lower() not in self.extensions:
+            return None
+        if self.has_patterns:
+            relative_path = relative_path or name
+            if self.include and not self.include(relative_path):
+                return None
+            if self.exclude and self.exclude(relative_path):
+                return None
+        return title, extension.upper()
+
+    def is_ignored_directory(self, name):
+        """
+        :param name: directory name
+        :return: True if the directory and everything below it should be skipped
+        """
+        name = name.lower()
+        return any(ignored in name for ignored in self.ignored_directories)
+
+
+def compile_patterns(patterns):
+    """
+    Compile glob and regex patterns into a single case insensitive match function. Globs must match the whole path,
+    patterns starting with "re:" are regular expressions that can match anywhere in it
+    :param patterns: list of patterns
+    :return: function taking a path and returning whether any pattern matches, or None if there are no patterns
+    """
+    if not patterns:
+        return None
+
+    expressions = [
+        f"(?:.*?{pattern[len(REGEX_PREFIX):]})" if pattern.startswith(REGEX_PREFIX) else fnmatch.translate(pattern)
+        for pattern in patterns
+    ]
+    regex = re.compile("|".join(expressions), re.IGNORECASE)
+    return lambda path: regex.match(path) is not None
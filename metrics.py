@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+PROMETHEUS_PREFIX = "game_archive_"
+# Upper bounds in seconds of the latency histogram buckets, the last bucket counts everything
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+
+class Histogram:
+    """ Cumulative latency histogram, in the shape Prometheus expects """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for position, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.counts[position] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 4),
+            'buckets': {format_bound(bound): count for bound, count in zip(self.buckets, self.counts)}
+        }
+
+
+class RunMetrics:
+    """
+    Phase timers, counters and latency histograms of a run, shared by every module through the module level metrics
+    object. Safe to update from worker threads. Metrics are named with optional labels, e.g. count("rawg_requests",
+    kind="search"), and written as a JSON run report and optionally a Prometheus textfile collector file
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.histograms = {}
+        self.sections = {}
+
+    @contextmanager
+    def phase(self, name, **labels):
+        """
+        Time a block of code, the time of a phase entered several times (e.g. once per console) adds up
+        :param name: phase name
+        :param labels: labels of the phase, e.g. console="SNES"
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = metric_key(name, labels)
+            with self.lock:
+                self.phases[key] = self.phases.get(key, 0.0) + time.perf_counter() - start
+
+    def count(self, name, value=1, **labels):
+        """
+        :param name: counter name
+        :param value: amount to add
+        :param labels: labels of the counter
+        """
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        :param name: histogram name
+        :param seconds: observed latency
+        :param labels: labels of the histogram
+        """
+        key = metric_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    def merge(self, report, **labels):
+        """
+        Add the metrics of another process, e.g. a rom root scanned in its own process. Its phases get the given labels
+        so they can be told apart, its counters add up with the ones of this process
+        :param report: run report of the other process
+        :param labels: labels added to its phases, e.g. root="/mnt/nas"
+        """
+        with self.lock:
+            for key, seconds in report['phases'].items():
+                name, phase_labels = split_key(key)
+                key = name + join_labels(phase_labels, **labels)
+                self.phases[key] = self.phases.get(key, 0.0) + seconds
+            for key, value in report['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def attach(self, name, value):
+        """
+        Add a section to the run report besides the metrics, e.g. the totals of each console read by the stats command
+        :param name: key of the section in the run report
+        :param value: JSON serializable value, replacing the one attached before
+        """
+        with self.lock:
+            self.sections[name] = value
+
+    def report(self):
+        """
+        :return: JSON serializable run report
+        """
+        with self.lock:
+            return {
+                'startedAt': datetime.fromtimestamp(self.started).isoformat(),
+                'runSeconds': round(time.time() - self.started, 4),
+                'phases': {key: round(seconds, 4) for key, seconds in self.phases.items()},
+                'counters': dict(self.counters),
+                'histograms': {key: histogram.as_dict() for key, histogram in self.histograms.items()},
+                **self.sections
+            }
+
+    def write(self, logger, report_path, prometheus_path=None):
+        """
+        Write the run report and log its summary as the final log line of the run
+        :param logger: logger
+        :param report_path: path of the JSON run report
+        :param prometheus_path: path of a Prometheus textfile collector file (ending in .prom), or None
+        """
+        report = self.report()
+        try:
+            write_atomically(report_path, json.dumps(report, indent=2))
+            if prometheus_path:
+                write_atomically(prometheus_path, self.prometheus_text(report))
+        except OSError as e:
+            logger.error("Unable to write the run report", extra={"reportPath": str(report_path), "error": str(e)})
+
+        logger.info("Run report",
+                    extra={
+                        "reportPath": str(report_path),
+                        "runSeconds": report['runSeconds'],
+                        "phases": {key: seconds for key, seconds in report['phases'].items() if '{' not in key},
+                        "counters": report['counters']
+                    })
+
+    def prometheus_text(self, report):
+        """
+        :param report: run report
+        :return: the metrics in the Prometheus text exposition format
+        """
+        lines = [
+            f"# TYPE {PROMETHEUS_PREFIX}last_run_timestamp_seconds gauge",
+            f"{PROMETHEUS_PREFIX}last_run_timestamp_seconds {self.started:.0f}",
+            f"# TYPE {PROMETHEUS_PREFIX}run_seconds gauge",
+            f"{PROMETHEUS_PREFIX}run_seconds {report['runSeconds']}",
+            f"# TYPE {PROMETHEUS_PREFIX}phase_seconds gauge",
+        ]
+        for key, seconds in sorted(report['phases'].items()):
+            name, labels = split_key(key)
+            lines.append(f"{PROMETHEUS_PREFIX}phase_seconds{join_labels(labels, phase=name)} {seconds}")
+
+        typed = set()
+        for key, value in sorted(report['counters'].items()):
+            name, labels = split_key(key)
+            if name not in typed:
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name}_total counter")
+                typed.add(name)
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_total{join_labels(labels)} {value}")
+
+        for key, histogram in sorted(report['histograms'].items()):
+            name, labels = split_key(key)
+            if name not in typed:
+                lines.append(f"# TYPE {PROMETHEUS_PREFIX}{name}_seconds histogram")
+                typed.add(name)
+            for bound, count in histogram['buckets'].items():
+                lines.append(f"{PROMETHEUS_PREFIX}{name}_seconds_bucket{join_labels(labels, le=bound)} {count}")
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_seconds_sum{join_labels(labels)} {histogram['sum']}")
+            lines.append(f"{PROMETHEUS_PREFIX}{name}_seconds_count{join_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def metric_key(name, labels):
+    """
+    :return: name of the metric with its labels, e.g. rawg_requests{kind="search"}
+    """
+    if not labels:
+        return name
+    return name + join_labels(labels)
+
+
+def split_key(key):
+    """
+    :return: (name, labels string without braces) tuple of a metric key
+    """
+    name, _, labels = key.partition('{')
+    return name, labels.rstrip('}')
+
+
+def join_labels(labels, **extra):
+    """
+    :param labels: labels string without braces, or a dict of labels
+    :param extra: labels added to them
+    :return: labels in braces, or an empty string when there are none
+    """
+    parts = [f'{label}="{escape(value)}"' for label, value in sorted(labels.items())] if isinstance(labels, dict) \
+        else [labels] if labels else []
+    parts += [f'{label}="{escape(value)}"' for label, value in extra.items()]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_bound(bound):
+    return "+Inf" if bound == float('inf') else str(bound)
+
+
+def write_atomically(path, text):
+    """ Write a file through a temporary file, so readers such as node_exporter never see a partial file """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(temp_path, path)
+
+
+metrics = RunMetrics()
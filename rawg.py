@@ -1,102 +1,562 @@
-import sys
-import requests
-from environs import Env
+import os
+import math
+import time
+import threading
+from pathlib import Path
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 
-env = Env()
+from rawg_cache import SECONDS_PER_DAY, RawgCache, trim_result
+from titles import TitleIndex, search_title, title_key
+from resilience import TokenBucket, CircuitBreaker
+from metrics import metrics
+from streams import WINDOW_PER_WORKER, ordered_map
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+ENRICHMENT_MODES = ('search', 'catalog')
+CATALOG_PAGE_SIZE = 40
+
+
+class RawgUnavailableError(Exception):
+    """ Raised when RAWG can't be reached after retrying, or the circuit breaker is refusing calls """
 
 
 class RawgApi:
-    def __init__(self, logger):
+    def __init__(self, logger, journal=None, deadline=None):
+        """
+        :param logger: logger
+        :param journal: RunJournal the lookups are recorded in, the lookups of an interrupted run are resumed from it
+        :param deadline: time.time() after which no new RAWG lookups are started, None to look every game up
+        """
         self.logger = logger
-        if env("RAWG_ENABLED", False):
+        self.journal = journal
+        self.deadline = deadline
+        self.deadline_reached = False
+        # Lookups that failed or were skipped at the deadline, the journal is then kept for the next run to retry them
+        self.unfinished_lookups = 0
+        if os.environ.get("RAWG_ENABLED"):
             self.logger.info("RAWG connectivity enabled by environment variable")
 
+            # environs and requests are only loaded when RAWG is enabled, and the environment read when it's created
+            from environs import Env  # pylint: disable=import-outside-toplevel
+
+            env = Env()
+
             self.enabled = True
             self.api_key = env("RAWG_API_KEY")
-            self.base_url = "https://api.rawg.io/api"
+            self.base_url = env("RAWG_BASE_URL", "https://api.rawg.io/api")
             self.base_params = {'key': self.api_key}
+            self.cache = self.setup_cache(self.logger, env)
+
+            self.workers = env.int("RAWG_WORKERS", 4)
+            self.timeout = env.float("RAWG_TIMEOUT", 10)
+            self.retries = env.int("RAWG_RETRIES", 3)
+            self.backoff = env.float("RAWG_BACKOFF", 0.5)
+            self.rate_limiter = TokenBucket(env.float("RAWG_RATE_LIMIT", 5))
+            self.circuit_breaker = CircuitBreaker(self.logger, "RAWG",
+                                                  threshold=env.int("RAWG_CIRCUIT_BREAKER_THRESHOLD", 5),
+                                                  cooldown=env.float("RAWG_CIRCUIT_BREAKER_COOLDOWN", 60))
+            self.session = self.setup_session(self.base_params, self.workers)
+            # Errors requests are retried on, as well as the retryable status codes
+            self.transient_errors = self.session_errors()
 
-            response = requests.request("GET", self.base_url, params=self.base_params)
-            if response.status_code == 200:
-                self.logger.info("Connected to RAWG api successfully", extra={'response': response})
-            else:
-                self.logger.error("Non 200 response status code recieved", extra={'response': response})
-                sys.exit(1)
+            self.enrichment_mode = env("RAWG_ENRICHMENT_MODE", "search").lower()
+            if self.enrichment_mode not in ENRICHMENT_MODES:
+                self.logger.error(f"Unknown RAWG enrichment mode, expected one of {ENRICHMENT_MODES}, using search",
+                                  extra={"enrichmentMode": self.enrichment_mode})
+                self.enrichment_mode = 'search'
+            self.catalog_max_pages = env.int("RAWG_CATALOG_MAX_PAGES", 250)
+            self.catalogs = {}
+            # RAWG platform id of each console short name, searches for the games of a console are filtered to it
+            self.platform_ids = {}
+            # Lookups of this run by (title key, console short name), shared by every game of the console with the key
+            self.lookups = {}
+            self.request_counts = Counter()
+            self.counter_lock = threading.Lock()
+            # Connectivity probe, started by connect() and waited for before the first lookup
+            self.connection = None
+            self.probed = False
+            if self.journal:
+                # Journaled lookups expire like cached ones, a run resumed weeks later searches RAWG again
+                self.resume_lookups(
+                    self.journal.resume(ttl=env.float("RAWG_CACHE_TTL_DAYS", 30) * SECONDS_PER_DAY,
+                                        miss_ttl=env.float("RAWG_CACHE_MISS_TTL_DAYS", 7) * SECONDS_PER_DAY))
         else:
             self.enabled = False
+            self.cache = None
             self.logger.info("RAWG not enabled.")
             self.logger.info("If you wish to enable it please set the RAWG_ENABLED and RAWG_API_KEY env vars.")
 
+    @staticmethod
+    def setup_cache(logger, env):
+        """
+        Create the local RAWG result cache, configured by environment variables
+        :param logger: logger
+        :param env: environs Env the settings are read from
+        :return: RawgCache, or None if disabled
+        """
+        if not env.bool("RAWG_CACHE_ENABLED", True):
+            logger.info("RAWG cache disabled by environment variable")
+            return None
+
+        return RawgCache(logger,
+                         env("RAWG_CACHE_PATH", str(Path(__file__).parent / "rawg_cache.sqlite3")),
+                         ttl_days=env.float("RAWG_CACHE_TTL_DAYS", 30),
+                         miss_ttl_days=env.float("RAWG_CACHE_MISS_TTL_DAYS", 7),
+                         max_entries=env.int("RAWG_CACHE_MAX_ENTRIES", 50000))
+
+    @staticmethod
+    def setup_session(base_params, workers):
+        """
+        Create a keep-alive session with a connection pool big enough for every enrichment worker
+        :param base_params: query parameters sent with every request (api key)
+        :param workers: number of threads sharing the session
+        :return: requests Session
+        """
+        import requests  # pylint: disable=import-outside-toplevel
+        from requests.adapters import HTTPAdapter  # pylint: disable=import-outside-toplevel
+
+        session = requests.Session()
+        session.params = dict(base_params)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, workers))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    @staticmethod
+    def session_errors():
+        """
+        :return: base exception type of requests, retried on: connection errors, timeouts, broken or undecodable
+                 response bodies and redirect loops
+        """
+        import requests  # pylint: disable=import-outside-toplevel
+
+        return requests.RequestException
+
+    def close(self):
+        if self.cache:
+            self.cache.close()
+        if self.enabled:
+            self.session.close()
+            self.logger.info("RAWG session closed",
+                             extra={
+                                 "enrichmentMode": self.enrichment_mode,
+                                 "requests": dict(self.request_counts),
+                                 "totalRequests": sum(self.request_counts.values())
+                             })
+
+    def connect(self):
+        """
+        Start probing the RAWG api in the background, so the probe runs while the library is scanned instead of
+        holding up the start of the run. Does nothing when already started or RAWG isn't enabled
+        """
+        if not self.enabled or self.connection:
+            return
+        self.connection = Future()
+
+        def probe():
+            try:
+                self.connection.set_result(self.session.get(self.base_url, timeout=self.timeout))
+            except BaseException as e:  # pylint: disable=broad-except
+                self.connection.set_exception(e)
+
+        threading.Thread(target=probe, name="rawg probe", daemon=True).start()
+
+    def wait_connected(self):
+        """
+        Wait for the connectivity probe before the first lookup. When the RAWG api can't be reached the circuit breaker
+        is opened, as it would be after failed lookups: cached results are still used and the other games are exported
+        without RAWG fields, until a trial call after the cooldown finds the api back
+        """
+        if not self.enabled or self.probed:
+            return
+        self.connect()
+        with metrics.phase("rawg_connect"):
+            try:
+                response = self.connection.result()
+                error = None if response.status_code == 200 else f"HTTP {response.status_code}"
+            except Exception as e:  # pylint: disable=broad-except
+                response, error = None, self.redact(e)
+        self.probed = True
+        if error:
+            self.logger.warning("Unable to connect to the RAWG api, only cached RAWG results are used",
+                                extra={
+                                    "baseUrl": self.base_url,
+                                    "error": error
+                                })
+            metrics.count("rawg_probe_failures")
+            self.circuit_breaker.trip()
+            return
+        self.logger.info("Connected to RAWG api successfully", extra={'response': response})
+
+    def resume_lookups(self, lookups):
+        """
+        Use the lookups of an interrupted run as lookups of this run, their games aren't looked up again
+        :param lookups: dict of (title key, platform) to RAWG result, see RunJournal.resume()
+        """
+        for key, result in lookups.items():
+            lookup = self.lookups[key] = Future()
+            lookup.set_result(result)
+        metrics.count("rawg_lookups_resumed", len(lookups))
+
+    @property
+    def enrichment_complete(self):
+        """ Whether every game was looked up, the run journal is only needed again when some weren't """
+        return not self.enabled or not self.unfinished_lookups
+
+    def past_deadline(self):
+        """
+        :return: whether the deadline is reached and no new lookups should be started, logged the first time only
+        """
+        if self.deadline is None or time.time() < self.deadline:
+            return False
+        with self.counter_lock:
+            first = not self.deadline_reached
+            self.deadline_reached = True
+        if first:
+            self.logger.warning("Deadline reached, no more RAWG lookups are started, the remaining games are exported "
+                                "without RAWG fields",
+                                extra={"deadline": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.deadline))})
+        return True
+
     def check_enabled(self):
         if self.enabled:
             return True
         self.logger.error("RAWG API not enabled.")
         return False
 
-    def get(self, url, params):
-        # Python 3.9+
-        if sys.version_info >= (3, 9):
-            return requests.request("GET", url=self.base_url + url, params=params | self.base_params)
+    def redact(self, error):
+        """
+        :param error: exception or error message of a request, connection errors include the url and its api key
+        :return: error message without the api key, safe to log
+        """
+        return str(error).replace(self.api_key, "***") if self.api_key else str(error)
+
+    def get(self, url, params, kind="search"):
+        """
+        Rate limited GET request against the RAWG api, retried with exponential backoff on any requests error
+        (connection errors, timeouts, truncated bodies, ...), rate limiting and server errors
+        :param url: api path, appended to the base url
+        :param params: query parameters, the api key is added by the session
+        :param kind: what the request is for, requests are counted per kind
+        :return: requests Response
+        :raises RawgUnavailableError: when every attempt failed or the circuit breaker is open
+        """
+        if not self.circuit_breaker.allow():
+            raise RawgUnavailableError("RAWG circuit breaker is open")
+
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2**(attempt - 1))
+            self.rate_limiter.acquire()
+            with self.counter_lock:
+                self.request_counts[kind] += 1
+            start = time.perf_counter()
+            try:
+                response = self.session.get(self.base_url + url, params=params, timeout=self.timeout)
+            except self.transient_errors as e:
+                metrics.count("rawg_requests", kind=kind, status="error")
+                error = e
+                continue
+            finally:
+                metrics.observe("rawg_request", time.perf_counter() - start, kind=kind)
+            metrics.count("rawg_requests", kind=kind, status=response.status_code)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                error = f"HTTP {response.status_code}"
+                continue
 
-        # < 3.9 bums
-        new_params = self.base_params
-        new_params.update(params)
+            self.circuit_breaker.record_success()
+            return response
 
-        return requests.request("GET", url=self.base_url + url, params=new_params)
+        self.circuit_breaker.record_failure()
+        raise RawgUnavailableError(f"RAWG request failed after {self.retries + 1} attempts: {self.redact(error)}")
+
+    def search_game(self, game_title, platform=None):
+        """
+        Find a game on RAWG, in the prefetched catalog of its platform, the cache or by searching. Titles are
+        normalized first, so every file of a game on a console (regions, revisions, discs of a set) shares a single
+        lookup, even when they are looked up at the same time by several workers. Searches are filtered to the RAWG
+        platform of the console and kept per console, so games of different consoles that happen to share a title key
+        never get each other's RAWG fields. Consoles without a RAWG platform id share one unfiltered search per title
+        :param game_title: game title or file name stem
+        :param platform: short name of the console the game belongs to
+        :return: trimmed RAWG game result, or None if it wasn't found
+        """
+        key = title_key(game_title)
+        if platform in self.catalogs:
+            result, _ = self.catalogs[platform].best(key)
+            if result:
+                metrics.count("rawg_matches", source="catalog")
+                if self.cache and not self.cache.contains(key, platform):
+                    self.cache.put(key, platform, result)
+                return result
+
+        platform_id = self.platform_ids.get(platform)
+        if not platform_id:
+            platform = None
+        with self.counter_lock:
+            lookup = self.lookups.get((key, platform))
+            owner = lookup is None
+            if owner:
+                lookup = self.lookups[(key, platform)] = Future()
+        if not owner:
+            metrics.count("rawg_lookups_shared")
+            return lookup.result()
 
-    def search_game(self, game_title):
         try:
-            response = self.get("/games", params={'search': game_title})
-            data = response.json()
+            result, final, fetched = self.lookup_game(game_title, key, platform, platform_id)
+        except BaseException as e:
+            # Games already waiting on the lookup get the error, the ones after them look the title up again
+            with self.counter_lock:
+                del self.lookups[(key, platform)]
+            lookup.set_exception(e)
+            raise
+        lookup.set_result(result)
+        if not final:
+            # Failed lookups are tried again by the next game with the title, and by the next run
+            with self.counter_lock:
+                del self.lookups[(key, platform)]
+                self.unfinished_lookups += 1
+        elif fetched and self.journal:
+            # Only RAWG answers are journaled, cache hits are found in the cache again by the next run
+            self.journal.record(key, platform, result)
+        return result
 
-            return data['results'][0]
+    def lookup_game(self, game_title, key, platform=None, platform_id=None):
+        """
+        Look a game up in the cache, or search RAWG for it and score the results against its title instead of taking
+        the first one
+        :param game_title: game title or file name stem
+        :param key: title key of the game, see titles.title_key()
+        :param platform: short name of the console the game belongs to, results are cached per console
+        :param platform_id: RAWG platform id the search is filtered to, or None to search every platform
+        :return: (trimmed RAWG game result or None, False when the lookup failed and should be tried again, True when
+                 the result came from RAWG rather than the cache) tuple
+        """
+        if self.cache:
+            found, result = self.cache.get(key, platform)
+            if found:
+                return result, True, False
 
-        except IndexError:
+        if self.past_deadline():
+            metrics.count("rawg_lookups_skipped", reason="deadline")
+            return None, False, False
+
+        params = {'search': search_title(game_title)}
+        if platform_id:
+            params['platforms'] = platform_id
+        try:
+            results = self.get("/games", params=params).json()['results']
+        except (RawgUnavailableError, ValueError, KeyError) as e:
+            self.logger.warning("RAWG search failed, game left without RAWG fields",
+                                extra={
+                                    "game_title": game_title,
+                                    "error": str(e)
+                                })
+            return None, False, False
+
+        result, score = TitleIndex((result.get('name') or '', result) for result in results).best(key)
+        if result:
+            result = trim_result(result)
+            metrics.count("rawg_matches", source="search", match="exact" if score == 1.0 else "fuzzy")
+        elif results:
+            self.logger.error("No close match found for game on RAWG.",
+                              extra={
+                                  "game_title": game_title,
+                                  "closestResult": results[0].get('name'),
+                                  "score": round(score, 2)
+                              })
+            metrics.count("rawg_matches", source="search", match="none")
+        else:
             self.logger.error("No results found for game on RAWG.", extra={"game_title": game_title})
+            metrics.count("rawg_matches", source="search", match="none")
 
-            return None
+        # Errors aren't cached, only actual results and "no results" answers
+        if self.cache:
+            self.cache.put(key, platform, result)
+        return result, True, True
+
+    def add_fields_to_archiver_game(self, archiver_game, platform=None):
+        return self.add_fields(archiver_game, self.search_game(archiver_game.title, platform))
 
-    def add_fields_to_archiver_game(self, archiver_game):
-        result = self.search_game(archiver_game['title'])
+    def add_fields(self, archiver_game, result):
+        """
+        Set the RAWG fields of a game from its RAWG result
+        :param archiver_game: Game record
+        :param result: RAWG game result, or None to set empty RAWG fields
+        :return: the game
+        """
         if result:
-            archiver_game['rawg_title'] = result['name']
-            archiver_game['rawg_release_date'] = result['released']
-            archiver_game['rawg_metacritic'] = result['metacritic']
+            archiver_game.rawg_title = result['name']
+            archiver_game.rawg_release_date = result['released']
+            archiver_game.rawg_metacritic = result['metacritic']
 
             try:
-                genres = []
-                for genre in result['genres']:
-                    genres.append(genre['name'])
-
-                archiver_game['rawg_genres'] = genres
+                archiver_game.rawg_genres = [genre['name'] for genre in result['genres']]
             except KeyError:
                 self.logger.error("Unable to add genres to this game, missing from RAWG",
                                   extra={
-                                      "game": archiver_game,
+                                      "game": archiver_game.as_dict(),
                                       "rawg_entry": result
                                   })
-                archiver_game['rawg_genres'] = None
+                archiver_game.rawg_genres = None
             try:
-                tags = []
-                for tag in result['tags']:
-                    tags.append(tag['name'])
-
-                archiver_game['rawg_tags'] = tags
+                archiver_game.rawg_tags = [tag['name'] for tag in result['tags']]
             except KeyError:
                 self.logger.error("Unable to add tags to this game, missing from RAWG",
                                   extra={
-                                      "game": archiver_game,
+                                      "game": archiver_game.as_dict(),
                                       "rawg_entry": result
                                   })
-                archiver_game['rawg_tags'] = None
+                archiver_game.rawg_tags = None
 
         else:
-            archiver_game['rawg_title'] = archiver_game['title']
-            archiver_game.update({
-                'rawg_release_date': None,
-                "rawg_metacritic": None,
-                'rawg_genres': None,
-                'rawg_tags': None
-            })
+            archiver_game.rawg_title = archiver_game.title
+            archiver_game.rawg_release_date = None
+            archiver_game.rawg_metacritic = None
+            archiver_game.rawg_genres = None
+            archiver_game.rawg_tags = None
 
         return archiver_game
+
+    def enrich_archivers(self, console_archivers):
+        """
+        Look up every game of every console on RAWG concurrently, adding the RAWG fields to the games in place.
+        Games that can't be looked up (RAWG down, circuit breaker open) still get empty RAWG fields
+        :param console_archivers: list of ConsoleArchiver objects
+        """
+        self.wait_connected()
+        for archiver in console_archivers:
+            self.platform_ids[archiver.short_name] = archiver.rawg_platform_id
+
+        # Games sharing a title key (regions, revisions, discs of a set) are looked up once per console
+        jobs = {}
+        for archiver in console_archivers:
+            for game in archiver.iter_games():
+                jobs.setdefault((title_key(game.title), archiver.short_name), []).append(game)
+        games = sum(len(job_games) for job_games in jobs.values())
+        self.logger.info("Starting RAWG enrichment",
+                         extra={
+                             "games": games,
+                             "uniqueTitles": len(jobs),
+                             "workers": self.workers,
+                             "enrichmentMode": self.enrichment_mode
+                         })
+
+        if self.enrichment_mode == 'catalog':
+            for archiver in console_archivers:
+                self.prefetch_catalog(archiver)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            results = executor.map(lambda job: self.search_game(job[1][0].title, job[0][1]), jobs.items())
+            for job_games, result in zip(jobs.values(), results):
+                for game in job_games:
+                    self.add_fields(game, result)
+                    self.logger.info("Fetched additional fields from RAWG api to add to this game",
+                                     extra={"game": game.as_dict()})
+
+        self.logger.info("RAWG enrichment finished",
+                         extra={
+                             "games": games,
+                             "uniqueTitles": len(jobs),
+                             "enrichmentMode": self.enrichment_mode,
+                             "unfinishedLookups": self.unfinished_lookups,
+                             "requests": dict(self.request_counts),
+                             "totalRequests": sum(self.request_counts.values())
+                         })
+
+    def enrich_stream(self, archiver):
+        """
+        Add the RAWG fields to a console's games as they are generated, for streaming exports, the games after the
+        one being written are looked up by the workers meanwhile
+        :param archiver: ConsoleArchiver in streaming mode
+        :return: generator of enriched games
+        """
+        self.wait_connected()
+        self.platform_ids[archiver.short_name] = archiver.rawg_platform_id
+        if self.enrichment_mode == 'catalog':
+            self.prefetch_catalog(archiver)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            yield from ordered_map(executor, lambda game: self.add_fields_to_archiver_game(game, archiver.short_name),
+                                   archiver.iter_games(), max(1, self.workers) * WINDOW_PER_WORKER)
+
+    def prefetch_catalog(self, archiver):
+        """
+        Page through RAWG's game listing for a console's platform once and index it by title, so the console's games
+        are matched locally and only unmatched titles are searched for. Skipped when paging through the platform would
+        take more requests than searching for each of the console's uncached games
+        :param archiver: ConsoleArchiver to prefetch the RAWG catalog for
+        """
+        if not archiver.rawg_platform_id:
+            self.logger.info(f"No rawgPlatformId configured for {archiver.short_name}, searching games one by one")
+            return
+
+        if self.past_deadline():
+            return
+
+        # Titles resumed from the run journal are already looked up
+        resumed = {key for key, platform in self.lookups if platform == archiver.short_name}
+        titles = {title_key(game.title) for game in archiver.iter_games()} - resumed
+        if self.cache:
+            titles = {title for title in titles if not self.cache.contains(title, archiver.short_name)}
+        if not titles:
+            return
+
+        first_page = self.get_catalog_page(archiver.rawg_platform_id, 1)
+        if not first_page:
+            return
+        pages = max(1, min(math.ceil(first_page.get('count', 0) / CATALOG_PAGE_SIZE), self.catalog_max_pages))
+        if pages > len(titles):
+            self.logger.info(f"RAWG catalog for {archiver.short_name} is larger than its uncached games, searching "
+                             f"games one by one instead",
+                             extra={
+                                 "catalogPages": pages,
+                                 "uncachedTitles": len(titles)
+                             })
+            return
+
+        results = list(first_page['results'])
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            for page in executor.map(lambda number: self.get_catalog_page(archiver.rawg_platform_id, number),
+                                     range(2, pages + 1)):
+                results.extend(page['results'] if page else [])
+
+        catalog = TitleIndex((result['name'], trim_result(result)) for result in results)
+        self.catalogs[archiver.short_name] = catalog
+        self.logger.info(f"RAWG catalog prefetched for {archiver.short_name}",
+                         extra={
+                             "catalogPages": pages,
+                             "catalogGames": len(catalog),
+                             "matchedTitles": len(catalog.match_all(titles)),
+                             "uncachedTitles": len(titles)
+                         })
+
+    def get_catalog_page(self, platform_id, page):
+        """
+        Get one page of RAWG's game listing for a platform
+        :param platform_id: RAWG platform id
+        :param page: page number, starting at 1
+        :return: response data with count and results, or None if the page couldn't be fetched
+        """
+        try:
+            data = self.get("/games",
+                            params={
+                                'platforms': platform_id,
+                                'page_size': CATALOG_PAGE_SIZE,
+                                'page': page
+                            },
+                            kind="catalog").json()
+            if 'results' in data:
+                return data
+            error = data
+        except (RawgUnavailableError, ValueError) as e:
+            error = str(e)
+        self.logger.warning("Unable to fetch RAWG catalog page",
+                            extra={
+                                "platformId": platform_id,
+                                "page": page,
+                                "error": error
+                            })
+        return None
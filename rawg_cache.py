@@ -0,0 +1,145 @@
+import json
+import sqlite3
+import threading
+import time
+
+from metrics import metrics
+
+SECONDS_PER_DAY = 86400
+# Results are committed in batches, a run that is killed loses at most this many, the run journal still has them
+COMMIT_EVERY = 100
+
+# Only the fields of a RAWG game result that are used for the spreadsheet are cached
+CACHED_FIELDS = ('name', 'released', 'metacritic')
+CACHED_NAMED_LISTS = ('genres', 'tags')
+
+
+class RawgCache:
+    """ Local SQLite cache of RAWG search results, keyed by normalized title and platform """
+    def __init__(self, logger, path, ttl_days=30, miss_ttl_days=7, max_entries=50000):
+        """
+        :param logger: logger
+        :param path: path of the SQLite database file
+        :param ttl_days: how long a found game is trusted before searching RAWG again
+        :param miss_ttl_days: how long a "no results" answer is trusted before searching RAWG again
+        :param max_entries: the least recently used entries beyond this many are evicted when the cache is closed
+        """
+        self.logger = logger
+        self.path = path
+        self.ttl = ttl_days * SECONDS_PER_DAY
+        self.miss_ttl = miss_ttl_days * SECONDS_PER_DAY
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.pending = 0
+
+        # Shared by the enrichment threads, every use of the connection is serialized by the lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(str(path), check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS games ("
+                                "title TEXT NOT NULL, "
+                                "platform TEXT NOT NULL, "
+                                "result TEXT, "
+                                "fetched_at REAL NOT NULL, "
+                                "accessed_at REAL NOT NULL, "
+                                "PRIMARY KEY (title, platform))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS games_accessed_at ON games (accessed_at)")
+        self.connection.commit()
+
+    def get(self, title, platform=None):
+        """
+        Look up a cached search result
+        :param title: game title as searched for
+        :param platform: platform the game belongs to
+        :return: (found, result) tuple, result is None for a cached "no results" answer
+        """
+        key = (normalize_title(title), platform or '')
+        with self.lock:
+            row = self.connection.execute("SELECT result, fetched_at FROM games WHERE title = ? AND platform = ?",
+                                          key).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > (self.ttl if row[0] is not None else self.miss_ttl):
+                self.misses += 1
+                metrics.count("rawg_cache_lookups", result="miss")
+                return False, None
+
+            self.connection.execute("UPDATE games SET accessed_at = ? WHERE title = ? AND platform = ?",
+                                    (now, ) + key)
+            self.hits += 1
+        metrics.count("rawg_cache_lookups", result="hit")
+        return True, None if row[0] is None else json.loads(row[0])
+
+    def contains(self, title, platform=None):
+        """
+        Check for a fresh cached entry without counting it as a hit or refreshing its access time
+        :param title: game title as searched for
+        :param platform: platform the game belongs to
+        :return: True if get() would return a cached answer
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT result, fetched_at FROM games WHERE title = ? AND platform = ?",
+                                          (normalize_title(title), platform or '')).fetchone()
+        return row is not None and time.time() - row[1] <= (self.ttl if row[0] is not None else self.miss_ttl)
+
+    def put(self, title, platform, result):
+        """
+        Store a search result, or a "no results" answer when result is None
+        :param title: game title as searched for
+        :param platform: platform the game belongs to
+        :param result: RAWG game result dict or None
+        """
+        now = time.time()
+        value = None if result is None else json.dumps(trim_result(result))
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?)",
+                                    (normalize_title(title), platform or '', value, now, now))
+            self.pending += 1
+            if self.pending >= COMMIT_EVERY:
+                self.connection.commit()
+                self.pending = 0
+
+    def evict(self):
+        """
+        Remove the least recently used entries beyond the configured maximum
+        :return: number of entries removed
+        """
+        removed = self.connection.execute(
+            "DELETE FROM games WHERE rowid IN "
+            "(SELECT rowid FROM games ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries, )).rowcount
+        self.connection.commit()
+        return removed
+
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            evicted = self.evict()
+            self.connection.close()
+        self.logger.info("RAWG cache closed",
+                         extra={
+                             "cachePath": str(self.path),
+                             "hits": self.hits,
+                             "misses": self.misses,
+                             "evicted": evicted
+                         })
+
+
+def normalize_title(title):
+    """
+    Normalize a title for use as a cache key, so case and spacing differences share an entry
+    :param title: game title
+    :return: normalized title
+    """
+    return " ".join(title.lower().split())
+
+
+def trim_result(result):
+    """
+    Reduce a RAWG game result to the fields used by the spreadsheet
+    :param result: RAWG game result dict
+    :return: dict with the same shape as the RAWG result, holding only the used fields
+    """
+    trimmed = {field: result[field] for field in CACHED_FIELDS if field in result}
+    for field in CACHED_NAMED_LISTS:
+        if field in result and result[field] is not None:
+            trimmed[field] = [{'name': entry['name']} for entry in result[field]]
+    return trimmed
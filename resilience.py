@@ -0,0 +1,87 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """ Thread safe token bucket rate limiter, acquire() blocks until a request fits within the configured rate """
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens added per second, 0 or less disables rate limiting
+        :param capacity: most tokens that can be saved up for a burst, defaults to one second worth
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Thread safe circuit breaker. After too many consecutive failures calls are refused for a cooldown period, then a
+    single trial call is let through to check whether the service has recovered
+    """
+    def __init__(self, logger, name, threshold=5, cooldown=60.0):
+        """
+        :param logger: logger
+        :param name: name of the protected service, for logging
+        :param threshold: consecutive failures before the circuit opens
+        :param cooldown: seconds to refuse calls for once open
+        """
+        self.logger = logger
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Check whether a call may be made right now
+        :return: False while the circuit is open
+        """
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Half open, let this call through as a trial and keep refusing the others until it reports back
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                self.logger.info(f"{self.name} circuit breaker closed, service recovered")
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    self.logger.error(f"{self.name} circuit breaker opened after {self.failures} consecutive failures, "
+                                      f"refusing calls for {self.cooldown} seconds")
+                self.opened_at = time.monotonic()
+
+    def trip(self):
+        """ Open the circuit right away, e.g. when a health check of the service failed """
+        with self.lock:
+            self.failures = max(self.failures, self.threshold)
+            self.opened_at = time.monotonic()
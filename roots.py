@@ -0,0 +1,181 @@
+import time
+import multiprocessing
+from collections import namedtuple
+
+from logger import logger as process_logger, log_settings
+from manifest import ScanManifest
+from scanner import LibraryIndex
+from metrics import metrics
+
+# Seconds a rom root gets to be scanned before the export goes on without it
+DEFAULT_ROOT_TIMEOUT = 1800
+# Seconds to wait for a scan process that failed or timed out to exit, before killing it or giving up on it
+PROCESS_JOIN_TIMEOUT = 5
+
+# A rom root directory, the console short names looked for under it (None for every console), its scan timeout in
+# seconds and the path of its own scan manifest
+RomRoot = namedtuple('RomRoot', ('path', 'consoles', 'timeout', 'manifest_path'))
+
+
+class MultiRootIndex:
+    """
+    The library indexes of every rom root used as one, e.g. for the workbook totals and watch mode. Sizes add up
+    and directories are looked up in the index of the root they are under
+    """
+    def __init__(self, scans):
+        """
+        :param scans: list of (RomRoot, LibraryIndex) tuples of the rom roots that were scanned
+        """
+        self.scans = scans
+
+    @property
+    def indexes(self):
+        return [index for _, index in self.scans]
+
+    @property
+    def size(self):
+        """
+        :return: total size of the rom roots in bytes, only the directories of its consoles count for a root limited to
+                 some consoles
+        """
+        return sum(root_size(root, index) for root, index in self.scans)
+
+    def index_of(self, path):
+        """
+        :param path: path of a directory
+        :return: LibraryIndex of the rom root the directory is indexed under, None if it isn't indexed
+        """
+        for index in self.indexes:
+            if index.find_nodes(path) is not None:
+                return index
+        return None
+
+    def find_nodes(self, path):
+        index = self.index_of(path)
+        return index.find_nodes(path) if index else None
+
+    def refresh(self, path, workers=1):
+        index = self.index_of(path)
+        return index.refresh(path, workers) if index else None
+
+    def save_manifests(self, logger, console_archivers):
+        """
+        Save the scan manifest of every rom root, with the games of the consoles found under it
+        :param logger: logger
+        :param console_archivers: list of ConsoleArchiver objects
+        """
+        for root, index in self.scans:
+            ScanManifest(logger, root.manifest_path).save(index, console_archivers)
+
+
+def root_size(root, index):
+    """
+    :param root: RomRoot
+    :param index: LibraryIndex of the rom root
+    :return: size of the rom root in bytes, or of the directories of its consoles when it is limited to some consoles
+    """
+    if root.consoles is None:
+        return index.size
+    nodes = (index.find_directory(short_name) for short_name in root.consoles)
+    return sum(node.size for node in nodes if node)
+
+
+def build_index(logger, root_path, manifest_path, scan_workers, full_rescan=False):
+    """
+    Walk a rom root once, reusing the listings of the directories that haven't changed since its scan manifest
+    :param logger: logger
+    :param root_path: rom root directory
+    :param manifest_path: path of the scan manifest of the rom root
+    :param scan_workers: number of threads listing directories
+    :param full_rescan: whether to ignore the scan manifest and list every directory again
+    :return: LibraryIndex
+    """
+    manifest = ScanManifest(logger, manifest_path)
+    if full_rescan:
+        logger.info("Full rescan requested, ignoring the scan manifest")
+    elif not manifest.load(root_path):
+        manifest = None
+    return LibraryIndex(logger, root_path, manifest).build(scan_workers)
+
+
+def scan_roots(logger, roots, scan_workers, full_rescan=False, logging_settings=None):
+    """
+    Scan every rom root in its own process, so a slow mount doesn't hold up the others, and a root that isn't done
+    scanning within its timeout (e.g. a hung NAS mount) is killed and left out of the export
+    :param logger: logger
+    :param roots: list of RomRoot
+    :param scan_workers: number of threads listing directories in each process
+    :param full_rescan: whether to ignore the scan manifests and list every directory again
+    :param logging_settings: logging section of the config file, applied in each process
+    :return: list of (RomRoot, LibraryIndex) tuples of the roots that were scanned in time
+    """
+    context = multiprocessing.get_context('spawn')
+    started = time.monotonic()
+    scans = []
+    for root in roots:
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=scan_root_process,
+                                  args=(sender, root, scan_workers, full_rescan, logging_settings),
+                                  name=f"scan {root.path}",
+                                  daemon=True)
+        process.start()
+        sender.close()
+        scans.append((root, process, receiver))
+
+    scanned = []
+    for root, process, receiver in scans:
+        try:
+            if not receiver.poll(max(0.0, started + root.timeout - time.monotonic())):
+                logger.error("Rom root not scanned within its timeout, exporting without it",
+                             extra={
+                                 "rootPath": root.path,
+                                 "timeoutSeconds": root.timeout
+                             })
+                metrics.count("root_scan_timeouts", root=root.path)
+                # Reaped so it doesn't linger as a zombie, a process stuck in a hung mount may not die until it returns
+                process.kill()
+                process.join(PROCESS_JOIN_TIMEOUT)
+                continue
+            index, report = receiver.recv()
+        except EOFError:
+            # The process died before sending its index, reap it so it doesn't linger as a zombie
+            process.join(PROCESS_JOIN_TIMEOUT)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            logger.error("Rom root scan process failed, exporting without it",
+                         extra={
+                             "rootPath": root.path,
+                             "exitCode": process.exitcode
+                         })
+            continue
+        finally:
+            receiver.close()
+        process.join()
+        metrics.merge(report, root=root.path)
+        scanned.append((root, index))
+    return scanned
+
+
+def scan_root_process(connection, root, scan_workers, full_rescan, logging_settings):
+    """
+    Entry point of a rom root's scan process, sends the LibraryIndex and the process' metrics back to the parent
+    :param connection: sending end of a pipe to the parent process
+    :param root: RomRoot to scan
+    :param scan_workers: number of threads listing directories
+    :param full_rescan: whether to ignore the scan manifest
+    :param logging_settings: logging section of the config file
+    """
+    log_settings.configure(logging_settings)
+    try:
+        with metrics.phase("scan"):
+            index = build_index(process_logger, root.path, root.manifest_path, scan_workers, full_rescan)
+        # The parent needs the games of the previous run to reuse them for unchanged consoles, but not the previous
+        # listings, the ones of this run are in the index
+        if index.manifest:
+            index.manifest.directories = {}
+        connection.send((index, metrics.report()))
+    finally:
+        connection.close()
+        # Write the queued log records of the process before it exits
+        log_settings.shutdown()
@@ -0,0 +1,251 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+
+class DirectoryNode:
+    """ In-memory snapshot of one directory: its files, subdirectories and total size """
+    __slots__ = ('name', 'path', 'mtime', 'files', 'subdirs', 'size', 'reused')
+
+    def __init__(self, name, path, mtime=0.0):
+        self.name = name
+        self.path = path
+        self.mtime = mtime
+        self.files = []  # (file_name, size_in_bytes) tuples, in directory listing order
+        self.subdirs = []
+        self.size = 0
+        self.reused = False  # True when the listing came from the scan manifest instead of the disk
+
+    def __repr__(self):
+        return f"DirectoryNode({self.path!r}, files={len(self.files)}, subdirs={len(self.subdirs)}, size={self.size})"
+
+    def walk(self, prune=None):
+        """
+        Iterate over this node and every node below it, parents before children (same order as a top-down os.walk)
+        :param prune: optional function taking a subdirectory node, returning True to skip it and everything below it
+        :return: generator of DirectoryNode
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            if prune:
+                stack.extend(subdir for subdir in reversed(node.subdirs) if not prune(subdir))
+            else:
+                stack.extend(reversed(node.subdirs))
+
+    def update_size(self):
+        """
+        Recalculate the total size of this node and everything below it from the indexed file sizes
+        :return: int size in bytes for the directory
+        """
+        for node in reversed(list(self.walk())):
+            node.size = sum(size for _, size in node.files) + sum(subdir.size for subdir in node.subdirs)
+        return self.size
+
+
+class LibraryIndex:
+    """ Single pass, in-memory index of the whole rom root shared by every ConsoleArchiver """
+    def __init__(self, logger, root_path, manifest=None):
+        self.logger = logger
+        self.root_path = root_path
+        self.manifest = manifest
+        self.root = DirectoryNode(os.path.basename(os.path.normpath(str(root_path))), str(root_path))
+        self.directories_scanned = 0
+        self.directories_reused = 0
+        self.files_indexed = 0
+        self.files_stated = 0
+
+    @property
+    def size(self):
+        return self.root.size
+
+    def build(self, workers=1):
+        """
+        Walk the rom root once with os.scandir, recording every file size and the total size of every directory.
+        Each level of the tree is listed in parallel (consoles, then game folders, ...) and merged back in listing
+        order, so the resulting index is the same no matter how many workers are used
+        :param workers: number of threads listing directories concurrently
+        :return: the index itself, to allow chaining
+        """
+        try:
+            stat = os.stat(self.root.path)
+            self.root.mtime = stat.st_mtime
+            visited = {(stat.st_dev, stat.st_ino)}
+        except OSError as e:
+            self.logger.error("Unable to read the rom root directory", extra={
+                'path': self.root.path,
+                'error': str(e)
+            })
+            return self
+
+        self.scan_tree([self.root], visited, workers)
+        self.root.update_size()
+        metrics.count("directories_walked", self.directories_scanned)
+        metrics.count("directories_reused", self.directories_reused)
+        metrics.count("files_stated", self.files_stated)
+        metrics.count("bytes_sized", self.root.size)
+        self.logger.info("Library index built.",
+                         extra={
+                             "rootPath": str(self.root_path),
+                             "scanWorkers": workers,
+                             "directoriesScanned": self.directories_scanned,
+                             "directoriesReused": self.directories_reused,
+                             "directoriesRescanned": self.directories_scanned - self.directories_reused,
+                             "filesIndexed": self.files_indexed,
+                             "totalSize": self.root.size
+                         })
+        return self
+
+    def scan_tree(self, nodes, visited, workers=1):
+        """
+        List the given directories and everything below them, one level of the tree at a time
+        :param nodes: DirectoryNode objects to list, their files and subdirs are filled in
+        :param visited: (device, inode) keys of the directories already in the index, updated in place
+        :param workers: number of threads listing directories concurrently
+        """
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            level = nodes
+            while level:
+                next_level = []
+                for node, (files, subdirs, reused) in zip(level, executor.map(self.scan_directory, level)):
+                    node.files = files
+                    node.reused = reused
+                    for subdir, key in subdirs:
+                        # Skip directories reachable twice through symlinks, and symlink loops
+                        if key in visited:
+                            continue
+                        visited.add(key)
+                        node.subdirs.append(subdir)
+                        next_level.append(subdir)
+                    self.directories_scanned += 1
+                    self.directories_reused += reused
+                    self.files_indexed += len(files)
+                    self.files_stated += 0 if reused else len(files)
+                level = next_level
+
+    def refresh(self, path, workers=1):
+        """
+        List a directory again after it changed, e.g. when watching the library. Subdirectories that are still there
+        keep their indexed subtree, new ones are listed in full, and the sizes of the directory and of every directory
+        above it are updated
+        :param path: path of an indexed directory
+        :param workers: number of threads listing new subdirectories concurrently
+        :return: list of the new DirectoryNode subdirectories, None if the directory isn't in the index
+        """
+        nodes = self.find_nodes(path)
+        if not nodes:
+            return None
+        node = nodes[-1]
+        try:
+            node.mtime = os.stat(node.path).st_mtime
+        except OSError:
+            pass
+        files, subdirs, _ = self.list_directory(node)
+        known = {subdir.name: subdir for subdir in node.subdirs}
+        node.files = files
+        node.reused = False
+        node.subdirs = []
+        new_subdirs = []
+        for subdir, _ in subdirs:
+            if subdir.name in known:
+                known[subdir.name].mtime = subdir.mtime
+                node.subdirs.append(known[subdir.name])
+            else:
+                node.subdirs.append(subdir)
+                new_subdirs.append(subdir)
+
+        self.scan_tree(new_subdirs, set(), workers)
+        for subdir in new_subdirs:
+            subdir.update_size()
+        for parent in reversed(nodes):
+            parent.size = sum(size for _, size in parent.files) + sum(subdir.size for subdir in parent.subdirs)
+        return new_subdirs
+
+    def find_nodes(self, path):
+        """
+        :param path: path of an indexed directory
+        :return: list of the DirectoryNode objects from the root down to the directory, None if it isn't indexed
+        """
+        relative = os.path.relpath(path, self.root.path)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        nodes = [self.root]
+        for name in [] if relative == os.curdir else relative.split(os.sep):
+            node = next((subdir for subdir in nodes[-1].subdirs if subdir.name == name), None)
+            if node is None:
+                return None
+            nodes.append(node)
+        return nodes
+
+    def scan_directory(self, node):
+        """
+        List a single directory, safe to call from several threads at once. When the scan manifest has a listing for
+        the directory and its mtime hasn't moved, only its subdirectories are stat'd instead of listing every file
+        :param node: DirectoryNode to list
+        :return: list of (file_name, size) tuples, list of (DirectoryNode, (device, inode)) subdirectory pairs and
+                 whether the listing was reused from the manifest
+        """
+        previous = self.manifest.previous_listing(node.path, node.mtime) if self.manifest else None
+        if previous:
+            return previous[0], self.stat_subdirs(node, previous[1]), True
+        return self.list_directory(node)
+
+    def list_directory(self, node):
+        """
+        List a single directory on disk with os.scandir
+        :param node: DirectoryNode to list
+        :return: list of (file_name, size) tuples, list of (DirectoryNode, (device, inode)) subdirectory pairs and
+                 False, the listing wasn't reused
+        """
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(node.path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir():
+                            stat = entry.stat()
+                            subdirs.append((DirectoryNode(entry.name, entry.path, stat.st_mtime),
+                                            (stat.st_dev, stat.st_ino)))
+                        else:
+                            files.append((entry.name, entry.stat().st_size))
+                    except OSError as e:
+                        self.logger.warning("Unable to stat directory entry, skipping", extra={
+                            'path': entry.path,
+                            'error': str(e)
+                        })
+        except OSError as e:
+            self.logger.warning("Unable to list directory, skipping", extra={'path': node.path, 'error': str(e)})
+        return files, subdirs, False
+
+    def stat_subdirs(self, node, subdir_names):
+        """
+        Stat the known subdirectories of an unchanged directory so their own mtimes can be checked
+        :param node: DirectoryNode of the unchanged directory
+        :param subdir_names: names of its subdirectories recorded in the manifest
+        :return: list of (DirectoryNode, (device, inode)) subdirectory pairs
+        """
+        subdirs = []
+        for name in subdir_names:
+            path = os.path.join(node.path, name)
+            try:
+                stat = os.stat(path)
+                subdirs.append((DirectoryNode(name, path, stat.st_mtime), (stat.st_dev, stat.st_ino)))
+            except OSError as e:
+                self.logger.warning("Unable to stat directory, skipping", extra={'path': path, 'error': str(e)})
+        return subdirs
+
+    def find_directory(self, name):
+        """
+        Find the first directory below the root with the given name (case insensitive), searched top-down
+        :param name: directory name to look for
+        :return: DirectoryNode or None if not found
+        """
+        name = name.lower()
+        for node in self.root.walk():
+            for subdir in node.subdirs:
+                if subdir.name.lower() == name:
+                    return subdir
+        return None
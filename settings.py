@@ -0,0 +1,53 @@
+import sys
+
+EXPORT_FORMATS = ('xlsx', 'csv', 'jsonl', 'sqlite')
+DEFAULT_EXPORTERS = ('xlsx', )
+
+
+def is_verifying(config):
+    """
+    Check whether any console has a DAT file configured to verify its games against
+    :param config: parsed config file
+    :return: True if games are verified
+    """
+    return any(console.get('datFile') for console in config['consoles'])
+
+
+def is_inspecting_archives(config):
+    """
+    Check whether the contents of zipped games are listed, from the zip central directories
+    :param config: parsed config file
+    :return: True if zips are inspected
+    """
+    return bool(config.get('inspectArchives'))
+
+
+def is_streaming_export(config):
+    """
+    Check whether the streaming export mode is configured, games are then generated from the library index while the
+    workbook is written in xlsxwriter's constant memory mode, instead of being kept in memory for the whole run. The
+    library index itself is still held in memory, so memory use grows with the number of files, not of games
+    :param config: parsed config file
+    :return: True for streaming export
+    """
+    return bool(config.get('streamingExport'))
+
+
+def get_export_formats(config, logger, requested=None):
+    """
+    Get the export formats to write this run, from the command line or else the config file
+    :param config: parsed config file
+    :param logger: logger
+    :param requested: formats requested on the command line, override the configured ones
+    :return: list of export formats, without repeats
+    """
+    formats = requested or config.get('exporters') or DEFAULT_EXPORTERS
+    unknown = [export_format for export_format in formats if export_format not in EXPORT_FORMATS]
+    if unknown:
+        logger.error("Unknown export formats configured, exiting",
+                     extra={
+                         "unknownFormats": unknown,
+                         "exportFormats": list(EXPORT_FORMATS)
+                     })
+        sys.exit(1)
+    return list(dict.fromkeys(formats))
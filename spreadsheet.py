@@ -2,183 +2,250 @@ from pathlib import Path
 import random
 from datetime import datetime
 
-import xlsxwriter
+from archiver import human_readable_size
+from verify import STATUSES
+from settings import is_verifying, is_inspecting_archives, is_streaming_export
+from metrics import metrics
 
-from archiver import human_readable_size, get_folder_size
+# Sizes are written in MiB, the binary units of the log, and stay numeric so Excel can still sort and sum them. Number
+# formats can only scale by powers of 1000, so the cells hold MiB rather than bytes scaled by the format
+SIZE_UNIT = 1024 * 1024
+SIZE_NUMBER_FORMAT = '[>=1]#,##0.00" MiB";0.000" MiB"'
 
 
 class ArchiveWorkbook:
     """ Custom workbook object for the archive result output """
-    def __init__(self, logger, config, root_path, console_archivers, rawg):
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, logger, config, root_path, library_index, console_archivers, rawg_enabled, path=None):
         self.logger = logger
         self.root_path = root_path
-        self.overview_tab, self.workbook = self.setup_workbook(config, root_path, self.logger)
+        self.library_index = library_index
+        self.overview_tab, self.workbook = self.setup_workbook(config, root_path, self.logger, path)
+        self.size_format = self.workbook.add_format({'num_format': SIZE_NUMBER_FORMAT})
         self.archivers = console_archivers
-        self.all_games = None
-        self.rawg = rawg
+        self.total_games = 0
+        self.columns = game_columns(rawg_enabled, is_verifying(config), is_inspecting_archives(config))
+        self.all_tab, self.all_color = None, None
+        self.console_tab, self.console_color, self.console_row_num = None, None, 1
 
-        self.logger.info("Created a new ArchiveWorkbook.", extra=self.__dict__)
+        self.logger.info("Created a new ArchiveWorkbook.",
+                         extra={
+                             "rootPath": str(root_path),
+                             "consoles": len(self.archivers),
+                             "columns": [column[0] for column in self.columns]
+                         })
 
     def update_overview_tab(self):
         """ Update the overview worksheet (tab) adding rows for each console and grand totals at the bottom """
         row_num = 1
         for console in self.archivers:
+            if not console.game_count:
+                continue
             self.overview_tab.write_row(row_num, 0,
                                         (console.console_name, console.company, console.short_name,
-                                         0 if not console.games else len(console.games), console.directory_size,
-                                         "Not Found" if not console.directory else console.directory))
+                                         console.game_count))
+            self.overview_tab.write(row_num, 4, size_value(console.directory_size), self.size_format)
+            self.overview_tab.write(row_num, 5, "Not Found" if not console.directory else console.directory)
+            if console.verification_counts:
+                self.overview_tab.write_row(row_num, 6, [console.verification_counts[status] for status in STATUSES])
             self.logger.info(f"Added a row for the {console.console_name} console on the Overview worksheet row "
                              f"{row_num}")
             row_num += 1
 
         total_format = self.workbook.add_format({'bold': True, 'bg_color': 'green', 'color': 'white'})
-        self.overview_tab.write_column(row_num + 3, 0, ("Total Games:", "Total Size:", "Exported on:"), total_format)
-
-        total_size = human_readable_size(get_folder_size(Path(self.root_path)))
-        total_games = len(self.all_games)
+        total_size = self.library_index.size
+        total_games = self.total_games
         date_exported = datetime.now().strftime("%m/%d/%Y")
 
-        self.overview_tab.write_column(row_num + 3, 1, (total_games, total_size, date_exported))
+        # Written row by row, rows can't be revisited once the next one is started in constant memory mode
+        totals = (("Total Games:", total_games, None), ("Total Size:", size_value(total_size), self.size_format),
+                  ("Exported on:", date_exported, None))
+        for offset, (label, value, value_format) in enumerate(totals):
+            self.overview_tab.write(row_num + 3 + offset, 0, label, total_format)
+            self.overview_tab.write(row_num + 3 + offset, 1, value, value_format)
         self.logger.info("Overview tab totals calculated and updated.",
                          extra={
                              "totalGames": f"{total_games}",
-                             "totalSize": f"{total_size}",
+                             "totalSize": human_readable_size(total_size),
                              "worksheet": self.overview_tab
                          })
         self.logger.info("Export date recorded", extra={"date_exported": date_exported})
 
-    def create_console_tabs(self):
-        """ Create worksheets (tabs) for each console with rows per game and totals at the bottom """
-        for archiver in self.archivers:
-            color = f'#{str(hex(random.randint(0, 16777215)))[2:].upper()}'
-            header_format = self.workbook.add_format({'bold': True, 'bg_color': color, 'color': 'white'})
-
-            console_tab = self.workbook.add_worksheet(archiver.console_name)
-
-            console_tab.write_row(0, 0, ("Game", "Filetype", "Size", "Path"), header_format)
-            console_tab.set_tab_color(color)
-            console_tab.set_column(0, 0, 35)
-            console_tab.set_column(3, 3, 80)
-
-            if self.rawg.enabled:
-                console_tab.write_row(0, 2, ("Released", "Size", "Genres", "Metacritic", "Tags", "Path"), header_format)
-                console_tab.set_column(2, 2, 15)
-                console_tab.set_column(3, 3, 10)
-                console_tab.set_column(4, 4, 30)
-                console_tab.set_column(5, 5, 15)
-                console_tab.set_column(6, 6, 30)
-                console_tab.set_column(7, 7, 80)
-
-            self.logger.info(f"Created worksheet (tab) for {archiver.console_name}", extra={"worksheet": console_tab})
-
-            row_num = 1
-            if archiver.games:
-                for game in archiver.games:
-
-                    if self.rawg.enabled:
-                        console_tab.write_row(row_num, 0,
-                                              (game["rawg_title"], game["filetype"], game['rawg_release_date'],
-                                               game["size"], ", ".join(game['rawg_genres']), game['rawg_metacritic'],
-                                               ", ".join(game['rawg_tags']), game["path"]))
-                    else:
-                        console_tab.write_row(row_num, 0, (game["title"], game["filetype"], game["size"], game["path"]))
-
-                    row_num += 1
-                self.logger.info(f"Wrote {len(archiver.games)} game rows to this worksheet",
-                                 extra={"worksheet": console_tab})
+    def start_game_tabs(self):
+        """
+        Add the all worksheet (tab), console worksheets are then added as their games are written. Rows only ever go
+        forward on each worksheet, so this works in xlsxwriter's constant memory mode with games generated straight
+        from the library index. Totals are accumulated as rows are written
+        """
+        self.all_tab, self.all_color = self.add_all_tab()
 
-            else:
-                self.logger.warning("No games for this console, no game rows written")
-                console_tab.write_row(row_num, 0, (f"No games found for this console in the '{archiver.short_name}' "
-                                                   f"directory (recursively searched)", "", "", ""))
-
-            write_tab_totals({
-                "workbook": self.workbook,
-                "tab": console_tab,
-                "row_num": row_num,
-                "games": archiver.games,
-                "size": archiver.directory_size,
-                "color": color
-            })
-            self.logger.info(f"Totals calculated and written for '{archiver.console_name}' worksheet")
-
-    def create_all_tab(self):
-        """ Create an all worksheet (tab) to display all games from all console and totals at the bottom """
-        row_num = 1
-        color = f'#{str(hex(random.randint(0, 16777215)))[2:].upper()}'
-        header_format = self.workbook.add_format({'bold': True, 'bg_color': color, 'color': 'white'})
-        all_tab = self.workbook.add_worksheet("All")
-        all_tab.set_tab_color(color)
-
-        all_tab.write_row(0, 0, ("Console", "Game", "Filetype", "Size", "Path"), header_format)
-        all_tab.set_column(0, 0, 10)
-        all_tab.set_column(1, 1, 35)
-        all_tab.set_column(4, 4, 80)
-
-        if self.rawg.enabled:
-            all_tab.write_row(0, 2, ("Filetype", "Released", "Size", "Genres", "Metacritic", "Tags", "Path"),
-                              header_format)
-            all_tab.set_column(3, 3, 15)
-            all_tab.set_column(4, 4, 10)
-            all_tab.set_column(5, 5, 30)
-            all_tab.set_column(6, 6, 15)
-            all_tab.set_column(7, 7, 30)
-            all_tab.set_column(8, 8, 80)
-
-        games = []
-        for archiver in self.archivers:
-            if archiver.games:
-                for game_num, game in enumerate(archiver.games):
-
-                    if self.rawg.enabled:
-                        game = self.rawg.add_fields_to_archiver_game(game)
-                        self.logger.info("Fetched additional fields from RAWG api to add to this game",
-                                         extra={"game": game})
-
-                        # Overwrite the game entry to have more details so we don't have to search again later
-                        archiver.games[game_num] = game
-                        games.append(game)
-
-                        all_tab.write_row(row_num, 0,
-                                          (archiver.short_name, game["rawg_title"], game["filetype"],
-                                           game['rawg_release_date'], game["size"], ", ".join(game['rawg_genres']),
-                                           game['rawg_metacritic'], ", ".join(game['rawg_tags']), game["path"]))
-                    else:
-                        games.append(game)
-                        all_tab.write_row(
-                            row_num, 0,
-                            (archiver.short_name, game['title'], game["filetype"], game["size"], game["path"]))
-
-                    row_num += 1
-
-        self.all_games = games
-
-        if games:
-            self.logger.info(f"Wrote {len(games)} game rows to the 'All' worksheet", extra={"worksheet": all_tab})
+    def add_game(self, archiver, game):
+        """
+        Write a game to the all worksheet and its console's worksheet, the console worksheet is added with its first
+        game so consoles are written one after the other
+        :param archiver: ConsoleArchiver of the game's console
+        :param game: Game record
+        """
+        if self.console_tab is None:
+            self.console_tab, self.console_color = self.add_console_tab(archiver)
+            self.console_row_num = 1
+
+        self.write_game_row(self.all_tab, self.total_games + 1, self.all_columns(), game)
+        self.write_game_row(self.console_tab, self.console_row_num, self.columns, game)
+        self.total_games += 1
+        self.console_row_num += 1
+
+    def end_console_tab(self, archiver):
+        """
+        Write the totals of a console's worksheet once all its games have been written
+        :param archiver: ConsoleArchiver of the console
+        """
+        if self.console_tab is None:
+            self.logger.warning(f"No games for the {archiver.console_name} console, no worksheet created")
+            return
+
+        self.logger.info(f"Wrote {self.console_row_num - 1} game rows to this worksheet",
+                         extra={"worksheet": self.console_tab})
+        write_tab_totals({
+            "workbook": self.workbook,
+            "tab": self.console_tab,
+            "row_num": self.console_row_num,
+            "game_count": self.console_row_num - 1,
+            "size": archiver.directory_size,
+            "size_format": self.size_format,
+            "color": self.console_color
+        })
+        self.logger.info(f"Totals calculated and written for '{archiver.console_name}' worksheet")
+        self.console_tab = None
+
+    def end_game_tabs(self):
+        """ Write the totals of the all worksheet once the games of every console have been written """
+        if self.total_games:
+            self.logger.info(f"Wrote {self.total_games} game rows to the 'All' worksheet",
+                             extra={"worksheet": self.all_tab})
 
         write_tab_totals({
             'workbook': self.workbook,
-            'tab': all_tab,
-            'row_num': row_num,
-            'games': games,
-            'size': human_readable_size(get_folder_size(Path(self.root_path))),
-            'color': color
+            'tab': self.all_tab,
+            'row_num': self.total_games + 1,
+            'game_count': self.total_games,
+            'size': self.library_index.size,
+            'size_format': self.size_format,
+            'color': self.all_color
         })
         self.logger.info("Totals calculated and written for 'All' worksheet")
 
+    def create_duplicates_tab(self, duplicate_groups):
+        """
+        Create a worksheet (tab) listing the roms with identical contents, one row per copy, copies of the same file
+        share a group number. The wasted size total only counts the extra copies of each file
+        :param duplicate_groups: list of (sha1, size, [Game, ...]) tuples, see DuplicateFinder.find()
+        """
+        columns = [("Group", 8, None, False), ("Console", 10, None, False), ("Game", 35, None, False),
+                   ("Filetype", None, None, False), ("Size", 12, None, True), ("SHA1", 42, None, False),
+                   ("Path", 80, None, False)]
+        duplicates_tab, color = self.add_tab("Duplicates", columns)
+
+        row_num = 1
+        for group_num, (digest, size, games) in enumerate(duplicate_groups, start=1):
+            for game in games:
+                duplicates_tab.write_row(row_num, 0, (group_num, game.console, game.title, game.filetype))
+                duplicates_tab.write(row_num, 4, size_value(size), self.size_format)
+                duplicates_tab.write_row(row_num, 5, (digest, game.path))
+                row_num += 1
+
+        self.logger.info(f"Wrote {row_num - 1} duplicate rows to this worksheet",
+                         extra={
+                             "worksheet": duplicates_tab,
+                             "duplicateGroups": len(duplicate_groups)
+                         })
+        write_tab_totals({
+            "workbook": self.workbook,
+            "tab": duplicates_tab,
+            "row_num": row_num,
+            "game_count": row_num - 1,
+            "size": sum(size * (len(games) - 1) for _, size, games in duplicate_groups),
+            "size_format": self.size_format,
+            "color": color
+        })
+
+    def all_columns(self):
+        """
+        :return: columns of the all worksheet, the console followed by the usual game columns
+        """
+        return [("Console", 10, lambda game: game.console, False)] + self.columns
+
+    def write_game_row(self, tab, row_num, columns, game):
+        """
+        Write one game row, values are only formatted here (sizes stay numeric with a size display format)
+        :param tab: worksheet to write to
+        :param row_num: row to write
+        :param columns: column definitions, see game_columns()
+        :param game: Game record
+        """
+        for col_num, (_, _, value, is_size) in enumerate(columns):
+            if is_size:
+                tab.write(row_num, col_num, size_value(value(game)), self.size_format)
+            else:
+                tab.write(row_num, col_num, value(game))
+
+    def add_console_tab(self, archiver):
+        """
+        Add the worksheet (tab) for a console with its header row
+        :param archiver: ConsoleArchiver of the console
+        :return: the worksheet and its color
+        """
+        console_tab, color = self.add_tab(archiver.console_name, self.columns)
+        self.logger.info(f"Created worksheet (tab) for {archiver.console_name}", extra={"worksheet": console_tab})
+        return console_tab, color
+
+    def add_all_tab(self):
+        """
+        Add the all worksheet (tab) with its header row
+        :return: the worksheet and its color
+        """
+        return self.add_tab("All", self.all_columns())
+
+    def add_tab(self, name, columns):
+        """
+        Add a game worksheet (tab) with a random color, header row and column widths
+        :param name: worksheet name
+        :param columns: column definitions, see game_columns()
+        :return: the worksheet and its color
+        """
+        color = f'#{str(hex(random.randint(0, 16777215)))[2:].upper()}'
+        header_format = self.workbook.add_format({'bold': True, 'bg_color': color, 'color': 'white'})
+
+        tab = self.workbook.add_worksheet(name)
+        tab.set_tab_color(color)
+        tab.write_row(0, 0, [header for header, _, _, _ in columns], header_format)
+        for col_num, (_, width, _, _) in enumerate(columns):
+            if width:
+                tab.set_column(col_num, col_num, width)
+
+        return tab, color
+
     def write(self):
-        self.workbook.close()
+        # Most of the workbook is only compressed and written to disk on close
+        with metrics.phase("workbook_close"):
+            self.workbook.close()
 
     @staticmethod
-    def setup_workbook(config, root_path, logger):
+    def setup_workbook(config, root_path, logger, path=None):
         """
         Initialize the workbook, set metadata, add the first worksheet, and other properties
         :param logger: logger
         :param config: parsed config file
         :param root_path: root path for consoles
+        :param path: file the workbook is written to, the configured workbook path by default
         :return: overview worksheet and the workbook
         """
-        workbook = xlsxwriter.Workbook(get_workbook_path(config, root_path, logger))
+        # Only commands writing a workbook load xlsxwriter
+        import xlsxwriter  # pylint: disable=import-outside-toplevel
+
+        # Constant memory mode flushes each row to a temporary file as soon as the next one is started
+        workbook = xlsxwriter.Workbook(path or get_workbook_path(config, root_path, logger),
+                                       {'constant_memory': is_streaming_export(config)})
         workbook.set_properties({
             "title": "Games List",
             "subject": "List of currently possessed games by console",
@@ -189,8 +256,10 @@ class ArchiveWorkbook:
 
         header_format = workbook.add_format({'bold': True, 'bg_color': 'green', 'color': 'white'})
         overview = workbook.add_worksheet("Library Overview")
-        overview.write_row(0, 0, ("Console", "Company", "Short Name", "Games", "Library Size", "Directory"),
-                           header_format)
+        headers = ("Console", "Company", "Short Name", "Games", "Library Size", "Directory")
+        if is_verifying(config):
+            headers += STATUSES
+        overview.write_row(0, 0, headers, header_format)
         overview.set_tab_color('green')
         overview.set_column(0, 0, 20)
         overview.set_column(1, 2, 10)
@@ -205,9 +274,64 @@ def write_tab_totals(tab_dict):
 
     total_format = tab_dict['workbook'].add_format({'bold': True, 'bg_color': tab_dict['color'], 'color': 'white'})
 
-    tab_dict['tab'].write_column(tab_dict['row_num'] + 3, 0, ("Total Games:", "Total Size:"), total_format)
-    tab_dict['tab'].write_column(tab_dict['row_num'] + 3, 1,
-                                 (0 if not tab_dict['games'] else len(tab_dict['games']), tab_dict['size']))
+    totals = (("Total Games:", tab_dict['game_count'], None),
+              ("Total Size:", size_value(tab_dict['size']), tab_dict['size_format']))
+    for offset, (label, value, value_format) in enumerate(totals):
+        tab_dict['tab'].write(tab_dict['row_num'] + 3 + offset, 0, label, total_format)
+        tab_dict['tab'].write(tab_dict['row_num'] + 3 + offset, 1, value, value_format)
+
+
+def size_value(size):
+    """
+    :param size: size in bytes, or None
+    :return: size in MiB as written to size cells, or None for an empty cell
+    """
+    return None if size is None else size / SIZE_UNIT
+
+
+def game_columns(rawg_enabled, verifying=False, inspecting_archives=False):
+    """
+    Columns written for each game on the console worksheets (the all worksheet adds a console column first)
+    :param rawg_enabled: whether the RAWG columns are included
+    :param verifying: whether the DAT verification column is included
+    :param inspecting_archives: whether the zip contents columns are included
+    :return: list of (header, width, function getting the cell value from a Game, whether it is a size) tuples
+    """
+    columns = game_info_columns(rawg_enabled)
+    if inspecting_archives:
+        columns[-1:-1] = [
+            ("Roms", 8, lambda game: game.zip_entry_count, False),
+            ("Multi-ROM", 10, lambda game: "Yes" if (game.zip_entry_count or 0) > 1 else None, False),
+            ("Uncompressed", 14, lambda game: game.zip_size, True),
+            ("Contents", 40, lambda game: ", ".join(game.zip_entries or []), False),
+        ]
+    if verifying:
+        columns.insert(-1, ("Verified", 10, lambda game: game.verified, False))
+    return columns
+
+
+def game_info_columns(rawg_enabled):
+    """
+    :param rawg_enabled: whether the RAWG columns are included
+    :return: the scanned and RAWG columns of game_columns()
+    """
+    if not rawg_enabled:
+        return [
+            ("Game", 35, lambda game: game.title, False),
+            ("Filetype", None, lambda game: game.filetype, False),
+            ("Size", 12, lambda game: game.size, True),
+            ("Path", 80, lambda game: game.path, False),
+        ]
+    return [
+        ("Game", 35, lambda game: game.rawg_title or game.title, False),
+        ("Filetype", None, lambda game: game.filetype, False),
+        ("Released", 15, lambda game: game.rawg_release_date, False),
+        ("Size", 12, lambda game: game.size, True),
+        ("Genres", 30, lambda game: ", ".join(game.rawg_genres or []), False),
+        ("Metacritic", 15, lambda game: game.rawg_metacritic, False),
+        ("Tags", 30, lambda game: ", ".join(game.rawg_tags or []), False),
+        ("Path", 80, lambda game: game.path, False),
+    ]
 
 
 # noinspection PyUnresolvedReferences
@@ -220,7 +344,7 @@ def get_workbook_path(config, root_path, logger, default_workbook_name="games_li
     :param default_workbook_name: if the filename isn't specified in the config, use this default one
     :return: full path to workbook file
     """
-    default_workbook_path = Path(root_path / default_workbook_name)
+    default_workbook_path = Path(root_path) / default_workbook_name
 
     if 'outputSpreadsheet' in config and config['outputSpreadsheet']:
         logger.info("Output workbook configured from file",
@@ -0,0 +1,23 @@
+from collections import deque
+
+# Calls submitted ahead of the consumer for each worker, enough to keep every worker busy while the consumer writes
+WINDOW_PER_WORKER = 4
+
+
+def ordered_map(executor, fn, iterable, window):
+    """
+    Map a function over an iterable on an executor, like Executor.map() but lazily: the iterable is only read as far
+    as the results are consumed, so a generator of games is never exhausted up front, and the results keep its order
+    :param executor: Executor the calls run on
+    :param fn: function called with each item
+    :param iterable: items to map, e.g. the games of a streaming export
+    :param window: most calls submitted and not yet consumed at once
+    :return: generator of the results
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
@@ -0,0 +1,39 @@
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from journal import RunJournal
+
+DAY = 86400
+
+
+def write_entries(path, entries):
+    path.write_text("".join(json.dumps(entry) + "\n" for entry in entries), encoding='utf-8')
+
+
+def test_record_round_trips_per_platform(tmp_path):
+    journal = RunJournal(logging.getLogger(__name__), tmp_path / "journal.jsonl")
+    journal.record("mario 64", "N64", {'name': "Super Mario 64"})
+    journal.record("mario 64", "DS", None)
+    journal.close()
+
+    lookups = RunJournal(logging.getLogger(__name__), tmp_path / "journal.jsonl").resume(ttl=DAY, miss_ttl=DAY)
+    assert lookups == {("mario 64", "N64"): {'name': "Super Mario 64"}, ("mario 64", "DS"): None}
+
+
+def test_resume_skips_expired_lookups(tmp_path):
+    now = time.time()
+    write_entries(tmp_path / "journal.jsonl", [
+        {'key': "found", 'platform': "SNES", 'result': {'name': "Found"}, 'fetchedAt': now - 2 * DAY},
+        {'key': "stale", 'platform': "SNES", 'result': {'name': "Stale"}, 'fetchedAt': now - 40 * DAY},
+        {'key': "missing", 'platform': "SNES", 'result': None, 'fetchedAt': now - 2 * DAY},
+        {'key': "untimed", 'platform': "SNES", 'result': None},
+    ])
+
+    lookups = RunJournal(logging.getLogger(__name__), tmp_path / "journal.jsonl").resume(ttl=30 * DAY, miss_ttl=DAY)
+    assert lookups == {("found", "SNES"): {'name': "Found"}}
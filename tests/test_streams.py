@@ -0,0 +1,33 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from streams import ordered_map
+
+
+def test_results_keep_the_order_of_the_items():
+    def slow_for_small(number):
+        time.sleep((10 - number) / 1000)
+        return number * 2
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(ordered_map(executor, slow_for_small, range(10), 4)) == [number * 2 for number in range(10)]
+
+
+def test_items_are_read_no_further_than_the_window():
+    read = []
+
+    def items():
+        for number in range(100):
+            read.append(number)
+            yield number
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = ordered_map(executor, lambda number: number, items(), 3)
+        assert next(results) == 0
+        assert len(read) == 3
+        results.close()
@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from titles import TitleIndex, title_key
+
+
+@pytest.mark.parametrize("title, other", [
+    ("Mega Man X", "Mega Man 10"),
+    ("Mega Man V", "Mega Man 5"),
+    ("X-Men", "10 Men"),
+    ("V-Rally", "5 Rally"),
+])
+def test_lone_numeral_letters_keep_distinct_keys(title, other):
+    assert title_key(title) != title_key(other)
+
+
+@pytest.mark.parametrize("title, other", [
+    ("Final Fantasy VII", "Final Fantasy 7"),
+    ("Final Fantasy VII - Advent Children", "Final Fantasy 7: Advent Children"),
+    ("Civilization VI (USA)", "Civilization 6"),
+    ("Legend of Zelda, The - A Link to the Past (USA) (Rev 1)", "The Legend of Zelda: A Link to the Past"),
+])
+def test_sequel_numerals_share_keys(title, other):
+    assert title_key(title) == title_key(other)
+
+
+def test_numerals_are_only_converted_in_sequel_position():
+    assert title_key("X-Men") == "x men"
+    assert title_key("XIII") == "xiii"
+    assert title_key("Rocky IV Special") == "rocky iv special"
+
+
+def test_numeral_letter_title_does_not_match_numbered_candidate():
+    index = TitleIndex([("Mega Man 10", "mega man 10")])
+    value, _ = index.best("Mega Man X")
+    assert value is None
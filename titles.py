@@ -0,0 +1,150 @@
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+# Candidates scoring below this are not considered the same game
+MATCH_THRESHOLD = 0.6
+# Score multiplier when the sequel numbers of two titles differ, e.g. Final Fantasy VII and Final Fantasy VIII
+NUMBER_MISMATCH_PENALTY = 0.5
+
+# (USA), [!], (Rev 1), (Disc 2), (En,Fr,De) ...
+TAGS = re.compile(r"\([^)]*\)|\[[^\]]*\]")
+# Disc, track and revision markers outside of brackets, e.g. "Game - Disc 2", "Game CD1", "Game v1.1"
+MARKERS = re.compile(r"[-_\s]*\b(?:(?:disc|disk|cd|dvd)\s*(?:\d+|[a-d])(?:\s*of\s*\d+)?|side\s*[ab12]|track\s*\d+"
+                     r"|(?:rev|revision)\s*(?:\d[\d.]*|[a-z])|v(?:er(?:sion)?)?\s*\d+(?:\.\d+)+)\b",
+                     re.IGNORECASE)
+# "Legend of Zelda, The - A Link to the Past"
+ARTICLE_SUFFIX = re.compile(r"^(.*?),\s*(the|a|an)\b(\s*[-:].*)?$", re.IGNORECASE)
+NON_ALPHANUMERIC = re.compile(r"[^a-z0-9]+")
+# Colons and dashes start a subtitle, "Final Fantasy VII - Advent Children"
+SUBTITLE_SEPARATORS = re.compile(r"[:\-\u2013\u2014]")
+# Sequel numbers, only converted at the end of a title or before its subtitle. A lone V or X is left alone, it is as
+# often a name as a number: Mega Man X isn't Mega Man 10, and Mega Man V isn't Mega Man 5
+ROMAN_NUMERALS = {
+    'ii': '2', 'iii': '3', 'iv': '4', 'vi': '6', 'vii': '7', 'viii': '8', 'ix': '9', 'xi': '11', 'xii': '12',
+    'xiii': '13', 'xiv': '14', 'xv': '15', 'xvi': '16'
+}
+IGNORED_TOKENS = frozenset(('the', 'a', 'an'))
+
+
+class TitleIndex:
+    """
+    Fuzzy index of candidate game titles, e.g. a RAWG platform catalog or the results of one search. Titles are
+    broken into character trigrams, and an inverted index from trigram to candidates scores every candidate sharing a
+    trigram with a title in one pass, instead of comparing the title with each candidate
+    """
+    def __init__(self, candidates):
+        """
+        :param candidates: iterable of (title, value) pairs, earlier candidates win ties
+        """
+        self.values = []
+        self.keys = []
+        self.gram_counts = []
+        self.exact = {}
+        self.postings = defaultdict(list)
+        for title, value in candidates:
+            key = title_key(title)
+            if not key:
+                continue
+            position = len(self.values)
+            grams = trigrams(key)
+            self.values.append(value)
+            self.keys.append(key)
+            self.gram_counts.append(len(grams))
+            self.exact.setdefault(key, position)
+            for gram in grams:
+                self.postings[gram].append(position)
+
+    def __len__(self):
+        return len(self.values)
+
+    def best(self, title, threshold=MATCH_THRESHOLD):
+        """
+        :param title: game title or file name stem
+        :param threshold: lowest score of a match
+        :return: (value of the best scoring candidate or None when none reaches the threshold, its score) tuple
+        """
+        key = title_key(title)
+        if key in self.exact:
+            return self.values[self.exact[key]], 1.0
+
+        grams = trigrams(key)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        if not shared:
+            return None, 0.0
+
+        numbers = number_tokens(key)
+        best_position, best_score = None, 0.0
+        for position, count in shared.items():
+            # Dice coefficient of the trigram sets
+            score = 2 * count / (len(grams) + self.gram_counts[position])
+            if number_tokens(self.keys[position]) != numbers:
+                score *= NUMBER_MISMATCH_PENALTY
+            if score > best_score or score == best_score and position < best_position:
+                best_position, best_score = position, score
+        if best_score < threshold:
+            return None, best_score
+        return self.values[best_position], best_score
+
+    def match_all(self, titles, threshold=MATCH_THRESHOLD):
+        """
+        :param titles: iterable of game titles, titles sharing a key are only scored once
+        :param threshold: lowest score of a match
+        :return: dict of title key to the value of its best match, for the titles that matched
+        """
+        matches = {}
+        for key in {title_key(title) for title in titles}:
+            value, _ = self.best(key, threshold)
+            if value is not None:
+                matches[key] = value
+        return matches
+
+
+def search_title(title):
+    """
+    Clean a file name stem up into the title to search for: region, revision and dump tags and disc/track markers are
+    removed, and a trailing article is moved to the front ("Legend of Zelda, The" -> "The Legend of Zelda")
+    :param title: game title or file name stem
+    :return: cleaned title, the original title if nothing would be left of it
+    """
+    cleaned = MARKERS.sub(" ", TAGS.sub(" ", title).replace("_", " "))
+    cleaned = " ".join(cleaned.split()).strip(" -.,")
+    article = ARTICLE_SUFFIX.match(cleaned)
+    if article:
+        cleaned = f"{article.group(2)} {article.group(1)}{article.group(3) or ''}"
+    return cleaned or title
+
+
+def title_key(title):
+    """
+    Key identifying a game whatever the file: every region, revision and disc of a game, and the same game on
+    several consoles, share a key. Accents, case, punctuation and articles are ignored, and sequel numbers written in
+    roman numerals are digits
+    :param title: game title or file name stem
+    :return: key made of the lowercase words of the title
+    """
+    text = unicodedata.normalize('NFKD', search_title(title))
+    text = "".join(character for character in text if not unicodedata.combining(character)).lower()
+    text = text.replace("&", " and ").replace("'", "")
+    tokens = []
+    for part in SUBTITLE_SEPARATORS.split(text):
+        words = [word for word in NON_ALPHANUMERIC.split(part) if word]
+        # The last word of the title or of a part of it is a sequel number, unless it is the first word of the title
+        if words and tokens + words[:-1]:
+            words[-1] = ROMAN_NUMERALS.get(words[-1], words[-1])
+        tokens += words
+    return " ".join(token for token in tokens if token not in IGNORED_TOKENS) or " ".join(tokens)
+
+
+def trigrams(key):
+    """
+    :return: set of the character trigrams of a title key, padded so the first and last letters count too
+    """
+    padded = f"  {key} "
+    return {padded[position:position + 3] for position in range(len(padded) - 2)}
+
+
+def number_tokens(key):
+    return {token for token in key.split() if token.isdigit()}
@@ -0,0 +1,274 @@
+import os
+import mmap
+import zlib
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ElementTree
+
+from containers import BadZipError
+from streams import WINDOW_PER_WORKER, ordered_map
+
+VERIFIED = "Verified"
+UNKNOWN = "Unknown"
+BAD = "Bad"
+STATUSES = (VERIFIED, UNKNOWN, BAD)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+DAT_GAME_TAGS = ('game', 'machine', 'software')
+
+
+class DatIndex:
+    """
+    Hash keyed index of a No-Intro, Redump or MAME (logiqx XML) DAT file. Only the hashes and names of the roms are
+    kept, the DAT is parsed incrementally and every game element is dropped once it has been indexed, so even
+    hundreds of MB of MAME DAT never have to be held in memory
+    """
+    def __init__(self, logger, path):
+        """
+        :param logger: logger
+        :param path: path of the DAT file
+        """
+        self.logger = logger
+        self.path = path
+        # (crc32, size) -> sha1 of the rom if the DAT has one, else None
+        self.crcs = {}
+        self.sha1s = set()
+        # Lowercase game and rom names, a file with a known name but unknown hashes is a bad dump
+        self.names = set()
+        self.game_count = 0
+
+    def load(self):
+        """
+        Parse the DAT file into the index
+        :return: True if the DAT file was read
+        """
+        try:
+            context = ElementTree.iterparse(self.path, events=('start', 'end'))
+            _, root = next(context)
+            for event, element in context:
+                if event != 'end':
+                    continue
+                tag = local_name(element.tag)
+                if tag == 'rom':
+                    self.add_rom(element)
+                elif tag in DAT_GAME_TAGS:
+                    if element.get('name'):
+                        self.names.add(element.get('name').lower())
+                    self.game_count += 1
+                    # Drop the game's elements, and the root's reference to them, now that its roms are indexed
+                    element.clear()
+                    root.clear()
+        except (OSError, ElementTree.ParseError, StopIteration) as e:
+            self.logger.error("Unable to read DAT file, games of this console won't be verified",
+                              extra={
+                                  "datFile": str(self.path),
+                                  "error": str(e)
+                              })
+            return False
+
+        self.logger.info("DAT file indexed",
+                         extra={
+                             "datFile": str(self.path),
+                             "games": self.game_count,
+                             "roms": len(self.crcs)
+                         })
+        return True
+
+    def add_rom(self, element):
+        name, crc, sha1 = element.get('name'), element.get('crc'), element.get('sha1')
+        if name:
+            self.names.add(os.path.basename(name.replace('\\', '/')).lower())
+        if sha1:
+            self.sha1s.add(sha1.lower())
+        if crc and element.get('size', '').isdigit():
+            self.crcs[(int(crc, 16), int(element.get('size')))] = sha1.lower() if sha1 else None
+
+    def check(self, crc, size, sha1=None):
+        """
+        :param crc: CRC32 of a rom as an int
+        :param size: size of the rom in bytes
+        :param sha1: hex SHA1 of the rom, when known
+        :return: True if the rom is in the DAT, False if its CRC matches but its SHA1 doesn't, otherwise None
+        """
+        if (crc, size) in self.crcs:
+            expected = self.crcs[(crc, size)]
+            return not (sha1 and expected and sha1 != expected)
+        if sha1 and sha1 in self.sha1s:
+            return True
+        return None
+
+    def has_name(self, *names):
+        return any(name.lower() in self.names for name in names)
+
+
+class DatVerifier:
+    """
+    Verifies the games of consoles with a DAT file configured. Zipped roms are checked against the CRCs stored in the
+    zip central directory so they never have to be decompressed, other files get their CRC32 and SHA1 computed in a
+    single mmap read on a thread pool. Hashes are kept in the file cache, so unchanged files are never read again
+    """
+    def __init__(self, logger, zip_reader, file_cache=None, workers=4):
+        """
+        :param logger: logger
+        :param zip_reader: ZipDirectoryReader listing the CRCs of zipped roms
+        :param file_cache: FileCache for the computed hashes, or None to always read the files
+        :param workers: number of threads reading files concurrently
+        """
+        self.logger = logger
+        self.zip_reader = zip_reader
+        self.file_cache = file_cache
+        self.workers = max(1, workers)
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get_index(self, archiver):
+        """
+        :param archiver: ConsoleArchiver
+        :return: DatIndex of the console's DAT file, or None if it has none or it can't be read
+        """
+        if not archiver.dat_file:
+            return None
+        with self.lock:
+            # Consoles can share a DAT file, it is only parsed once
+            if archiver.dat_file not in self.indexes:
+                index = DatIndex(self.logger, archiver.dat_file)
+                self.indexes[archiver.dat_file] = index if index.load() else None
+            return self.indexes[archiver.dat_file]
+
+    def verify_archivers(self, console_archivers):
+        """
+        Verify every game of the consoles with a DAT file, setting each game's verified status in place
+        :param console_archivers: list of ConsoleArchiver objects
+        """
+        for archiver in console_archivers:
+            index = self.get_index(archiver)
+            if not index or not archiver.games:
+                continue
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for game in executor.map(lambda game, index=index: self.verify_game(game, index), archiver.games):
+                    archiver.verification_counts[game.verified] += 1
+            self.log_counts(archiver)
+
+    def verify_stream(self, archiver, games):
+        """
+        Verify a console's games as they are generated, for streaming exports, hashing the next files on the worker
+        pool while the verified ones are written
+        :param archiver: ConsoleArchiver in streaming mode
+        :param games: iterable of the console's games
+        :return: generator of verified games
+        """
+        index = self.get_index(archiver)
+        if not index:
+            yield from games
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for game in ordered_map(executor, lambda game: self.verify_game(game, index), games,
+                                    self.workers * WINDOW_PER_WORKER):
+                archiver.verification_counts[game.verified] += 1
+                yield game
+        self.log_counts(archiver)
+
+    def verify_game(self, game, index):
+        """
+        :param game: Game to verify, its verified field is set to Verified, Unknown or Bad
+        :param index: DatIndex of the game's console
+        :return: the game
+        """
+        if game.filetype == "FOLDER":
+            game.verified = UNKNOWN
+        elif game.filetype == "ZIP":
+            game.verified = self.verify_zip(game, index)
+        else:
+            game.verified = self.verify_file(game, index)
+        return game
+
+    def verify_zip(self, game, index):
+        """
+        Check every rom of a zip by the CRC and size recorded in its central directory, nothing is decompressed
+        :return: Verified if every rom is in the DAT, Bad if any isn't but the zip or rom name is, otherwise Unknown
+        """
+        try:
+            entries = self.zip_reader.entries(game.path)
+        except BadZipError as e:
+            self.logger.warning("Unreadable zip file, marking it as a bad dump",
+                                extra={
+                                    "path": game.path,
+                                    "error": str(e)
+                                })
+            return BAD
+        except OSError as e:
+            self.logger.warning("Unable to read zip file, it can't be verified",
+                                extra={
+                                    "path": game.path,
+                                    "error": str(e)
+                                })
+            return UNKNOWN
+
+        unmatched = [entry for entry in entries if not index.check(entry.crc, entry.size)]
+        if entries and not unmatched:
+            return VERIFIED
+        names = [os.path.basename(entry.name) for entry in unmatched]
+        return BAD if index.has_name(game.title, *names) else UNKNOWN
+
+    def verify_file(self, game, index):
+        """
+        :return: Verified if the file's hashes are in the DAT, Bad if they aren't but its name is, otherwise Unknown
+        """
+        hashes = self.file_hashes(game.path)
+        if not hashes:
+            return UNKNOWN
+        crc, sha1 = hashes
+        match = index.check(crc, game.size, sha1)
+        if match:
+            return VERIFIED
+        if match is False or index.has_name(game.title, os.path.basename(game.path)):
+            return BAD
+        return UNKNOWN
+
+    def file_hashes(self, path):
+        """
+        :param path: file path
+        :return: (crc32 int, sha1 hex) tuple from the file cache or a single read of the file, None if unreadable
+        """
+        try:
+            stat = os.stat(path)
+            if self.file_cache:
+                crc = self.file_cache.get(path, "crc32", stat.st_size, stat.st_mtime_ns)
+                sha1 = self.file_cache.get(path, "sha1", stat.st_size, stat.st_mtime_ns)
+                if crc and sha1:
+                    return int(crc, 16), sha1
+
+            crc, sha1 = 0, hashlib.sha1()
+            if stat.st_size:
+                with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    with memoryview(mapped) as view:
+                        for offset in range(0, len(mapped), HASH_BLOCK_SIZE):
+                            with view[offset:offset + HASH_BLOCK_SIZE] as block:
+                                crc = zlib.crc32(block, crc)
+                                sha1.update(block)
+
+            if self.file_cache:
+                self.file_cache.put(path, "crc32", stat.st_size, stat.st_mtime_ns, f"{crc:08x}")
+                self.file_cache.put(path, "sha1", stat.st_size, stat.st_mtime_ns, sha1.hexdigest())
+            return crc, sha1.hexdigest()
+
+        except (OSError, ValueError) as e:
+            self.logger.warning("Unable to hash file, it can't be verified", extra={"path": path, "error": str(e)})
+            return None
+
+    def log_counts(self, archiver):
+        self.logger.info(f"Verified the {archiver.console_name} games against the DAT file",
+                         extra={
+                             "datFile": str(archiver.dat_file),
+                             **{status.lower(): archiver.verification_counts[status] for status in STATUSES}
+                         })
+
+
+def local_name(tag):
+    """
+    :param tag: element tag, possibly with a {namespace} prefix
+    :return: the tag without its namespace
+    """
+    return tag.rpartition('}')[2]
@@ -0,0 +1,283 @@
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+
+from manifest import is_within
+
+# inotify event flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# Files being written only count once they are closed, so a rom being copied is sized when the copy is done
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF \
+    | IN_ONLYDIR
+# struct inotify_event: int wd, uint32_t mask, uint32_t cookie, uint32_t len, then len bytes of name
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+# Changes are applied once no event arrived for the debounce time, or at the latest after this many debounce times
+MAX_DEBOUNCE_WINDOWS = 6
+
+
+class Inotify:
+    """ Minimal ctypes binding of the Linux inotify api, raises OSError where inotify isn't available """
+    def __init__(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            inotify_init1 = self.libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, "inotify is not available on this system") from e
+        self.fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise last_os_error()
+
+    def add_watch(self, path):
+        """
+        :param path: directory to watch, its subdirectories have to be watched separately
+        :return: watch descriptor, raises OSError with errno ENOSPC when the max_user_watches limit is reached
+        """
+        watch = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if watch < 0:
+            raise last_os_error(path)
+        return watch
+
+    def remove_watch(self, watch):
+        # Fails when the directory is already gone, which removed the watch anyway
+        self.libc.inotify_rm_watch(self.fd, watch)
+
+    def read_events(self, timeout):
+        """
+        :param timeout: seconds to wait for events
+        :return: list of (watch descriptor, mask, name) tuples, empty when none arrived before the timeout
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            watch, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            events.append((watch, mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+            offset += length
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """
+    Long running watch mode. Keeps the library index and the games of each console up to date from inotify events on
+    the console directories, and writes the exports again once the changes have settled. Falls back to rescanning the
+    whole library periodically when inotify isn't available or its watch limit is reached
+    """
+    def __init__(self, logger, library_index, console_archivers, debounce=10, rescan_interval=900, workers=1):
+        """
+        :param logger: logger
+        :param library_index: LibraryIndex of the initial scan, refreshed in place
+        :param console_archivers: ConsoleArchiver objects of the initial scan, refreshed in place
+        :param debounce: seconds without events before the changes are applied
+        :param rescan_interval: seconds between full rescans when inotify can't be used
+        :param workers: number of threads listing new directories
+        """
+        self.logger = logger
+        self.library_index = library_index
+        self.archivers = console_archivers
+        self.debounce = debounce
+        self.rescan_interval = rescan_interval
+        self.workers = workers
+        self.inotify = None
+        self.watches = {}  # watch descriptor -> directory path
+        self.watched = {}  # directory path -> watch descriptor
+        self.changed_directories = set()
+
+    def run(self, regenerate, rescan):
+        """
+        Watch the library until interrupted
+        :param regenerate: function taking the library index, every ConsoleArchiver and the changed ones, writes the
+                           exports again
+        :param rescan: function scanning the whole library again, returning a new (library_index, console_archivers)
+        """
+        try:
+            try:
+                self.inotify = Inotify()
+                self.sync_watches()
+            except OSError as e:
+                self.fall_back(e)
+            if self.inotify:
+                self.watch(regenerate)
+            self.poll(regenerate, rescan)
+        except KeyboardInterrupt:
+            self.logger.info("Watch mode stopped")
+        finally:
+            if self.inotify:
+                self.inotify.close()
+
+    def watch(self, regenerate):
+        """
+        Apply the inotify events as they arrive, returns only when inotify can't watch every directory anymore
+        :param regenerate: see run()
+        """
+        self.logger.info("Watching the console directories for changes",
+                         extra={
+                             "directories": len(self.watched),
+                             "debounceSeconds": self.debounce
+                         })
+        first_event, last_event = None, None
+        while True:
+            timeout = self.debounce if last_event is None else max(0.0, last_event + self.debounce - time.monotonic())
+            events = self.inotify.read_events(timeout)
+            for watch, mask, name in events:
+                self.handle_event(watch, mask, name)
+            now = time.monotonic()
+            if events:
+                first_event, last_event = first_event or now, now
+            if not self.changed_directories or (now - last_event < self.debounce
+                                                and now - first_event < self.debounce * MAX_DEBOUNCE_WINDOWS):
+                continue
+
+            first_event, last_event = None, None
+            changed = self.apply_changes()
+            try:
+                self.sync_watches()
+            except OSError as e:
+                self.fall_back(e)
+            if changed:
+                regenerate(self.library_index, self.archivers, changed)
+            if not self.inotify:
+                return
+
+    def handle_event(self, watch, mask, name):
+        """ Record the directory an event happened in, it is listed again once the changes have settled """
+        if mask & IN_Q_OVERFLOW:
+            # Events were dropped, every watched directory has to be listed again
+            self.logger.warning("inotify event queue overflowed, listing every watched directory again")
+            self.changed_directories.update(self.watched)
+            return
+        path = self.watches.get(watch)
+        if path is None:
+            return
+        if mask & IN_IGNORED:
+            self.forget_watch(path)
+        elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # The parent directory gets its own event for the directory leaving, its watch no longer matches its path.
+            # Listing it again empties it when it's a console directory, whose parent isn't watched
+            self.inotify.remove_watch(watch)
+            self.forget_watch(path)
+            self.changed_directories.add(path)
+        else:
+            self.logger.debug("Library change", extra={"path": os.path.join(path, name), "mask": mask})
+            self.changed_directories.add(path)
+
+    def apply_changes(self):
+        """
+        List the changed directories again and search the consoles they belong to for games again
+        :return: list of the changed ConsoleArchiver objects
+        """
+        # Parents first, their new subdirectories are listed in full so refreshing those again is cheap
+        for path in sorted(self.changed_directories, key=lambda path: path.count(os.sep)):
+            self.library_index.refresh(path, self.workers)
+
+        changed = [
+            archiver for archiver in self.archivers
+            if any(is_within(path, archiver.directory) for path in self.changed_directories)
+        ]
+        self.changed_directories.clear()
+        for archiver in changed:
+            archiver.refresh(self.library_index)
+        return changed
+
+    def sync_watches(self):
+        """ Watch every directory below the console directories, and stop watching the ones that are gone """
+        paths = set()
+        for archiver in self.archivers:
+            if archiver.directory_node:
+                paths.update(node.path for node in archiver.directory_node.walk())
+
+        for path in set(self.watched) - paths:
+            self.inotify.remove_watch(self.watched[path])
+            self.forget_watch(path)
+        for path in paths - set(self.watched):
+            try:
+                watch = self.inotify.add_watch(path)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+                self.logger.warning("Unable to watch directory, skipping", extra={'path': path, 'error': str(e)})
+                continue
+            self.watched[path] = watch
+            self.watches[watch] = path
+
+    def forget_watch(self, path):
+        watch = self.watched.pop(path, None)
+        if self.watches.get(watch) == path:
+            del self.watches[watch]
+
+    def fall_back(self, error):
+        """ Stop using inotify, the library is rescanned periodically instead """
+        self.logger.warning("Unable to watch the library with inotify, rescanning it periodically instead. Raise "
+                            "fs.inotify.max_user_watches if the watch limit was reached",
+                            extra={
+                                "error": str(error),
+                                "watchedDirectories": len(self.watched),
+                                "rescanSeconds": self.rescan_interval
+                            })
+        if self.inotify:
+            self.inotify.close()
+        self.inotify = None
+        self.watches.clear()
+        self.watched.clear()
+
+    def poll(self, regenerate, rescan):
+        """
+        Rescan the whole library every rescan interval, the scan manifest keeps unchanged directories from being
+        listed again. The exports are only written again when a console changed
+        :param regenerate: see run()
+        :param rescan: see run()
+        """
+        while True:
+            time.sleep(self.rescan_interval)
+            library_index, console_archivers = rescan()
+            previous = {archiver.short_name: fingerprint(archiver) for archiver in self.archivers}
+            changed = [
+                archiver for archiver in console_archivers if previous.get(archiver.short_name) != fingerprint(archiver)
+            ]
+            if not changed and len(console_archivers) == len(self.archivers):
+                self.logger.info("Library unchanged since the last scan")
+                continue
+            # Every console of the rescan has new game records, so they all need their fields added again
+            self.library_index, self.archivers = library_index, console_archivers
+            regenerate(library_index, console_archivers, console_archivers)
+
+
+def fingerprint(archiver):
+    """
+    :return: size and modification time of every directory below a console directory, any change to its files
+             changes one of them
+    """
+    if not archiver.directory_node:
+        return None
+    return tuple((node.path, node.mtime, node.size) for node in archiver.directory_node.walk())
+
+
+def last_os_error(path=None):
+    error = ctypes.get_errno()
+    return OSError(error, os.strerror(error), path)